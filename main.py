@@ -1,7 +1,18 @@
-import argparse, os, logging
-from src.TilesToGpkg import TilesToGpkg
+import argparse, os, logging, contextlib
+from src.TilesToGpkg import TilesToGpkg, DEFAULT_WATCH_BATCH_SIZE, DEFAULT_WATCH_BATCH_WAIT, DEFAULT_CHECKPOINT_INTERVAL
 from src.utils import gpkg_dump, execute_sql
 from src.GpkgToTiles import GpkgToTiles
+from src.TileFilter import TileFilter, parse_zoom_range, parse_tile_rectangle
+from src.CompletenessCheck import CompletenessCheck
+from src.Metrics import Metrics, METRICS_FORMATS, JSON_FORMAT, DEFAULT_METRICS_INTERVAL
+from src.Profiling import Profiler
+from src.TileWriter import WRITERS, OGR_WRITER
+from src.TileReaderPool import DEFAULT_READ_WORKERS, DEFAULT_READ_QUEUE_SIZE
+from src.TileDiscovery import DEFAULT_DISCOVERY_WORKERS
+from src.constants import TILES_LAYOUTS, ROWID_LAYOUT, WATCH_BACKENDS, EVENTS_WATCH_BACKEND
+from src.PollingWatcher import DEFAULT_POLL_INTERVAL
+from src.ArchiveSource import is_archive_source, STDIN_SOURCE
+from src.SQLiteProfile import SQLITE_PROFILES, DEFAULT_PROFILE
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +25,7 @@ def main():
         metavar=("SOURCE_PATH"),
         default=os.getcwd(),
         help="Specify the root folder for tiles retrieval. Default is the current working directory.\n"
-            "You can provide a custom source path.",
+            "You can provide a custom source path, a .tar, .tar.gz or .zip archive, or '-' to read a tar stream from stdin.",
     )
     parser.add_argument(
         "--gpkg_path",
@@ -37,6 +48,138 @@ def main():
         help="Specify watch patterns if using watcher. Default is ['*.terrain', 'layer.json'].\n"
             "You can provide a list of file patterns to watch.",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        metavar=("TILES"),
+        default=0,
+        help="Group inserts into transactions of up to TILES tiles. Default is 0 (every insert is committed on its own).",
+    )
+    parser.add_argument(
+        "--batch_interval",
+        type=float,
+        metavar=("SECONDS"),
+        default=0,
+        help="Commit the current transaction after SECONDS seconds, even if --batch_size was not reached. Default is 0 (no time window).",
+    )
+    parser.add_argument(
+        "--catch_up",
+        action="store_true",
+        help="With --watch, ingest the tiles that already exist in the source path while the watcher buffers new events, then process the buffered events.",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=float,
+        metavar=("SECONDS"),
+        default=DEFAULT_CHECKPOINT_INTERVAL,
+        help=f"In watch mode, checkpoint the WAL into the GeoPackage every SECONDS seconds. 0 leaves it to SQLite. Default is {DEFAULT_CHECKPOINT_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--watch_backend",
+        choices=WATCH_BACKENDS,
+        default=EVENTS_WATCH_BACKEND,
+        help="How the watcher detects new files. 'events' uses filesystem notifications, 'polling' periodically checks the directories and works on network mounts such as NFS. Default is 'events'.",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        metavar=("SECONDS"),
+        default=DEFAULT_POLL_INTERVAL,
+        help=f"Seconds between two polls of the source directory with --watch_backend polling. Default is {DEFAULT_POLL_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--watch_batch_size",
+        type=int,
+        metavar=("EVENTS"),
+        default=DEFAULT_WATCH_BATCH_SIZE,
+        help=f"In watch mode, insert up to EVENTS queued files in one transaction. Default is {DEFAULT_WATCH_BATCH_SIZE}.",
+    )
+    parser.add_argument(
+        "--watch_batch_wait",
+        type=float,
+        metavar=("SECONDS"),
+        default=DEFAULT_WATCH_BATCH_WAIT,
+        help=f"In watch mode, wait at most SECONDS seconds for a batch to fill before inserting it. Default is {DEFAULT_WATCH_BATCH_WAIT}.",
+    )
+    parser.add_argument(
+        "--writer",
+        choices=WRITERS,
+        default=OGR_WRITER,
+        help="Backend used to insert tiles. 'ogr' writes through GDAL/OGR layers, 'sqlite' inserts rows directly with sqlite3. Default is 'ogr'.",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=TILES_LAYOUTS,
+        default=ROWID_LAYOUT,
+        help="Storage layout of the terrain_tiles table. 'rowid' appends tiles in ingest order, 'clustered' uses the tile coordinates as the fid so tiles are stored in (zoom_level, tile_column, tile_row) order. Default is 'rowid'.",
+    )
+    parser.add_argument(
+        "--sqlite_profile",
+        choices=SQLITE_PROFILES,
+        default=DEFAULT_PROFILE,
+        help="SQLite tuning applied while ingesting. 'bulk' uses a 64 KB page size, a large cache, mmap and relaxed fsync, then restores safe settings and runs ANALYZE at the end. Default is 'default' (no tuning).",
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Store byte-identical tiles once in the tile_blobs table and reference them from terrain_tiles. --extract and --dump resolve the references.",
+    )
+    parser.add_argument(
+        "--read_workers",
+        type=int,
+        metavar=("THREADS"),
+        default=DEFAULT_READ_WORKERS,
+        help="Read tile files with THREADS concurrent threads while a single writer inserts them. Default is 0 (read and insert in the same thread).",
+    )
+    parser.add_argument(
+        "--read_queue_size",
+        type=int,
+        metavar=("TILES"),
+        default=DEFAULT_READ_QUEUE_SIZE,
+        help=f"Maximum number of tiles waiting to be read or written when using --read_workers. Default is {DEFAULT_READ_QUEUE_SIZE}.",
+    )
+    parser.add_argument(
+        "--discovery_workers",
+        type=int,
+        metavar=("THREADS"),
+        default=DEFAULT_DISCOVERY_WORKERS,
+        help=f"Number of threads scanning the source tree for tiles. Default is {DEFAULT_DISCOVERY_WORKERS}.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        metavar=("PROCESSES"),
+        default=0,
+        help="Split the source tree by zoom/column directories across PROCESSES worker processes, each writing its own shard GeoPackage, and merge the shards at the end. Default is 0 (single process).",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar=("PATH"),
+        help="Write throughput, queue depths, per-stage latencies and ETA of the ingest or extraction to PATH periodically. '-' writes JSON lines to stdout.",
+    )
+    parser.add_argument(
+        "--metrics_format",
+        choices=METRICS_FORMATS,
+        default=JSON_FORMAT,
+        help="'json' appends one JSON line per interval, 'prometheus' replaces PATH with a Prometheus textfile. Default is 'json'.",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        metavar=("SECONDS"),
+        default=DEFAULT_METRICS_INTERVAL,
+        help=f"Seconds between two metrics writes. Default is {DEFAULT_METRICS_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in every stage of the ingest or extraction (discovery, reads, encoding, inserts, commits, history flushes...) when it ends.",
+    )
+    parser.add_argument(
+        "--profile_output",
+        metavar=("PATH"),
+        help="Also run the main thread under cProfile, write the stats to PATH and print the top functions. Implies --profile.",
+    )
     parser.add_argument(
         "--dump",
         nargs="+",
@@ -47,7 +190,46 @@ def main():
         "--extract",
         nargs='+',
         metavar=("SOURCE_GPKG","OUTPUT_DIR"),
-        help="Extract data from gpkg (generated with this CLI) back to files. Optionally, include the number of workers for parallel processing. (Default 2)",
+        help="Extract data from gpkg (generated with this CLI) back to files. Optionally, include the number of file writer threads. (Default 2)",
+    )
+    parser.add_argument(
+        "--extract_processes",
+        type=int,
+        default=0,
+        metavar="PROCESSES",
+        help="Split the --extract table in contiguous key ranges extracted by PROCESSES processes, each with its own read-only connection and its own writer threads. (Default 0, a single process)",
+    )
+    parser.add_argument(
+        "--extract_incremental",
+        action="store_true",
+        help="Only write the --extract tiles that are missing or changed in OUTPUT_DIR, using the manifest of the previous incremental run (or the existing files) to compare them.",
+    )
+    parser.add_argument(
+        "--extract_zoom",
+        nargs="+",
+        type=parse_zoom_range,
+        metavar="ZOOM_RANGE",
+        help="Only extract the tiles of these zoom levels, e.g. 12 or 10-14.",
+    )
+    parser.add_argument(
+        "--extract_tiles",
+        nargs="+",
+        type=parse_tile_rectangle,
+        metavar="TILE_RANGE",
+        help="Only extract the tiles in these z/x0-x1/y0-y1 ranges (the format reported by --check), e.g. 14/8100-8200/3000-3050.",
+    )
+    parser.add_argument(
+        "--extract_bbox",
+        nargs=4,
+        type=float,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Only extract the tiles intersecting this lon/lat bbox (degrees) in the geographic tiling scheme, at every zoom level or at the --extract_zoom levels.",
+    )
+    parser.add_argument(
+        "--check",
+        nargs="+",
+        metavar=("SOURCE", "LAYER_JSON"),
+        help="Compare the tiles of a source directory or a GeoPackage (generated with this CLI) with the available ranges of its layer.json, and report missing and extra tiles. Optionally, provide another layer.json to check against.",
     )
     parser.add_argument(
        '--execute_sql',
@@ -66,17 +248,43 @@ def main():
     logLevel = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(level=logLevel)
 
+    if args.metrics_interval <= 0:
+        parser.error("--metrics_interval must be positive.")
+    if args.metrics == "-" and args.metrics_format != JSON_FORMAT:
+        parser.error("--metrics - only supports the json format.")
+    metrics = Metrics(args.metrics, args.metrics_format, args.metrics_interval)
+    profiler = Profiler(metrics, args.profile_output) if args.profile or args.profile_output else contextlib.nullcontext()
+
     if args.extract is not None and len(args.extract) not in (2, 3):
         parser.error('OUTPUT_DIR and SOURCE_GPKG are required for the extraction tool')
     elif args.extract:
         SOURCE_GPKG = args.extract[0]
         OUTPUT_DIR = args.extract[1]
         WORKERS = int(args.extract[2]) if len(args.extract) > 2 else None
-        if WORKERS is not None and int(WORKERS) > os.cpu_count():
-            parser.error(f'You cannot use more than {os.cpu_count()} workers in your system.')
+        # The writer threads wait on I/O, only the processes are bound by the cores
+        if WORKERS is not None and WORKERS < 1:
+            parser.error('The number of workers must be positive.')
+        if args.extract_processes < 0:
+            parser.error('--extract_processes cannot be negative.')
+        if args.extract_processes > os.cpu_count():
+            parser.error(f'You cannot use more than {os.cpu_count()} processes in your system.')
+        if args.extract_bbox:
+            west, south, east, north = args.extract_bbox
+            if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+                parser.error('--extract_bbox must be WEST SOUTH EAST NORTH in degrees, with WEST < EAST and SOUTH < NORTH.')
+
+        tile_filter = None
+        if args.extract_zoom or args.extract_tiles or args.extract_bbox:
+            tile_filter = TileFilter(args.extract_zoom, args.extract_tiles, args.extract_bbox)
         
-        gpkg_to_tiles = GpkgToTiles(SOURCE_GPKG, OUTPUT_DIR, WORKERS)
-        gpkg_to_tiles.execute()
+        gpkg_to_tiles = GpkgToTiles(SOURCE_GPKG, OUTPUT_DIR, WORKERS, metrics, args.extract_processes, tile_filter,
+                                    args.extract_incremental)
+        metrics.start()
+        try:
+            with profiler:
+                gpkg_to_tiles.execute()
+        finally:
+            metrics.close()
 
     elif args.dump:
         if len(args.dump) < 2:
@@ -92,20 +300,71 @@ def main():
         logger.info("Successfully merged sources to destination")
         exit(0)
     
+    elif args.check is not None and len(args.check) not in (1, 2):
+        parser.error("--check takes SOURCE and optionally LAYER_JSON.")
+
+    elif args.check:
+        if not os.path.exists(args.check[0]):
+            parser.error(f"{args.check[0]} does not exist.")
+
+        completeness_check = CompletenessCheck(args.check[0], args.check[1] if len(args.check) > 1 else None, args.discovery_workers)
+        exit(0 if completeness_check.execute() else 1)
+
     elif args.execute_sql:
         exit(execute_sql(args.execute_sql[1], args.execute_sql[0]))
 
-    elif not os.path.exists(args.src_path):
+    elif args.src_path != STDIN_SOURCE and not os.path.exists(args.src_path):
         parser.error("Invalid source path. Please specify an existing directory.")
 
+    elif is_archive_source(args.src_path) and (args.watch or args.shards > 1):
+        parser.error("--watch and --shards cannot be used with an archive source.")
+
     elif args.watch and not args.watch_patterns:
         parser.error("Please specify watch patterns.")
+
+    elif args.batch_size < 0 or args.batch_interval < 0:
+        parser.error("--batch_size and --batch_interval must not be negative.")
+
+    elif args.catch_up and not args.watch:
+        parser.error("--catch_up can only be used with --watch.")
+
+    elif args.checkpoint_interval < 0:
+        parser.error("--checkpoint_interval must not be negative.")
+
+    elif args.poll_interval <= 0:
+        parser.error("--poll_interval must be positive.")
+
+    elif args.watch_batch_size < 1 or args.watch_batch_wait < 0:
+        parser.error("--watch_batch_size must be at least 1 and --watch_batch_wait must not be negative.")
+
+    elif args.read_workers < 0 or args.read_queue_size < 1:
+        parser.error("--read_workers must not be negative and --read_queue_size must be at least 1.")
+
+    elif args.discovery_workers < 1:
+        parser.error("--discovery_workers must be at least 1.")
+
+    elif args.shards < 0 or (args.shards > 1 and args.watch):
+        parser.error("--shards must not be negative and cannot be used with --watch.")
+
     else:
+        metrics.start()
         try:
-            tiles_to_gpkg = TilesToGpkg(args.src_path, args.gpkg_path, args.watch, [*args.watch_patterns])
+            with profiler:
+                tiles_to_gpkg = TilesToGpkg(args.src_path, args.gpkg_path, args.watch, [*args.watch_patterns],
+                                           batch_size=args.batch_size, batch_interval=args.batch_interval,
+                                           writer=args.writer, read_workers=args.read_workers,
+                                           read_queue_size=args.read_queue_size, shards=args.shards,
+                                           discovery_workers=args.discovery_workers, layout=args.layout,
+                                           sqlite_profile=args.sqlite_profile, dedupe=args.dedupe,
+                                           watch_batch_size=args.watch_batch_size, watch_batch_wait=args.watch_batch_wait,
+                                           watch_backend=args.watch_backend, poll_interval=args.poll_interval,
+                                           catch_up=args.catch_up, checkpoint_interval=args.checkpoint_interval,
+                                           metrics=metrics)
         except Exception as e:
             logger.error(f"Error initializing TilesToGpkg: {e}")
             exit(1)
+        finally:
+            metrics.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
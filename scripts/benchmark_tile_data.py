@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""CPU seconds per million tiles of the hex round trip and of raw bytes for tile_data.
+
+Usage: python scripts/benchmark_tile_data.py [TILES] [TILE_SIZE_BYTES]
+"""
+import os, sys, time, sqlite3
+
+DEFAULT_TILES = 100000
+DEFAULT_TILE_SIZE = 16 * 1024
+
+def per_million(seconds, tiles):
+    return seconds * 1000000 / tiles
+
+def measure(label, tiles, blobs, func):
+    start = time.process_time()
+    for i in range(tiles):
+        func(blobs[i % len(blobs)])
+    elapsed = time.process_time() - start
+    print(f"{label:<45} {per_million(elapsed, tiles):10.2f} CPU seconds / 1M tiles")
+    return elapsed
+
+def bench_python(tiles, blobs):
+    measure("hex encode + decode (python only)", tiles, blobs, lambda data: bytes.fromhex(data.hex()))
+
+def bench_sqlite(tiles, blobs):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE terrain_tiles (fid INTEGER PRIMARY KEY, tile_data BLOB)")
+
+    def insert_hex(data):
+        conn.execute("INSERT INTO terrain_tiles (tile_data) VALUES (?)", (bytes.fromhex(data.hex()),))
+
+    def insert_raw(data):
+        conn.execute("INSERT INTO terrain_tiles (tile_data) VALUES (?)", (data,))
+
+    conn.execute("BEGIN")
+    hex_time = measure("sqlite3 insert, hex round trip", tiles, blobs, insert_hex)
+    raw_time = measure("sqlite3 insert, raw bytes", tiles, blobs, insert_raw)
+    conn.execute("ROLLBACK")
+    conn.close()
+    print(f"{'sqlite3 saved':<45} {per_million(hex_time - raw_time, tiles):10.2f} CPU seconds / 1M tiles")
+
+def bench_ogr(tiles, blobs):
+    try:
+        from osgeo import ogr
+    except ImportError:
+        print("GDAL python bindings are not installed, skipping OGR benchmark")
+        return
+
+    ds = ogr.GetDriverByName("Memory").CreateDataSource("benchmark")
+    layer = ds.CreateLayer("terrain_tiles", geom_type=ogr.wkbNone)
+    layer.CreateField(ogr.FieldDefn("tile_data", ogr.OFTBinary))
+    layer_defn = layer.GetLayerDefn()
+
+    def set_hex(data):
+        feature = ogr.Feature(layer_defn)
+        feature.SetFieldBinaryFromHexString("tile_data", data.hex())
+
+    hex_time = measure("OGR SetFieldBinaryFromHexString", tiles, blobs, set_hex)
+
+    if not hasattr(ogr.Feature, "SetFieldBinary"):
+        print("This GDAL version has no Feature.SetFieldBinary, only the hex path is available")
+        return
+
+    def set_raw(data):
+        feature = ogr.Feature(layer_defn)
+        feature.SetFieldBinary("tile_data", data)
+
+    raw_time = measure("OGR SetFieldBinary", tiles, blobs, set_raw)
+    print(f"{'OGR saved':<45} {per_million(hex_time - raw_time, tiles):10.2f} CPU seconds / 1M tiles")
+
+def main(argv):
+    tiles = int(argv[1]) if len(argv) > 1 else DEFAULT_TILES
+    tile_size = int(argv[2]) if len(argv) > 2 else DEFAULT_TILE_SIZE
+    blobs = [os.urandom(tile_size) for _ in range(64)]
+
+    print(f"{tiles} tiles of {tile_size} bytes")
+    bench_python(tiles, blobs)
+    bench_sqlite(tiles, blobs)
+    bench_ogr(tiles, blobs)
+
+if __name__ == "__main__":
+    main(sys.argv)
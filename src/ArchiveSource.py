@@ -0,0 +1,31 @@
+import sys, tarfile, zipfile, posixpath
+from src.utils import patterns_match
+
+# Source path that reads a tar stream from stdin
+STDIN_SOURCE = "-"
+
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+ZIP_EXTENSIONS = (".zip",)
+
+def is_archive_source(source):
+    return source == STDIN_SOURCE or source.lower().endswith(TAR_EXTENSIONS + ZIP_EXTENSIONS)
+
+def iterate_archive_files(source, patterns):
+    """Yields (member_path, data) of the files of a tar / zip archive, or a tar stream on stdin, matching the patterns"""
+    if source.lower().endswith(ZIP_EXTENSIONS):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and patterns_match(posixpath.basename(info.filename), patterns):
+                    yield info.filename, archive.read(info)
+        return
+
+    # Stream mode reads the archive front to back, compressed and piped tars included
+    if source == STDIN_SOURCE:
+        archive = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*")
+    else:
+        archive = tarfile.open(source, mode="r|*")
+
+    with archive:
+        for member in archive:
+            if member.isfile() and patterns_match(posixpath.basename(member.name), patterns):
+                yield member.name, archive.extractfile(member).read()
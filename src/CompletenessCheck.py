@@ -0,0 +1,200 @@
+import os, json, sqlite3, logging, time
+from bisect import bisect_left, bisect_right
+from tabulate import tabulate
+from src.constants import TERRAIN_TILES_TABLE, LAYER_JSON_TABLE
+from src.TileDiscovery import TileDiscovery, DEFAULT_DISCOVERY_WORKERS
+
+# Missing / extra rectangles printed in the report, the totals are always complete
+MAX_REPORTED_RANGES = 20
+
+logger = logging.getLogger(__name__)
+
+# Row sets are sorted lists of disjoint, non-adjacent inclusive (start, end) intervals
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def subtract_intervals(intervals, removed):
+    """intervals minus removed, both merged"""
+    result = []
+    i = 0
+    for start, end in intervals:
+        while i < len(removed) and removed[i][1] < start:
+            i += 1
+        j = i
+        while j < len(removed) and removed[j][0] <= end:
+            if removed[j][0] > start:
+                result.append((start, removed[j][0] - 1))
+            start = max(start, removed[j][1] + 1)
+            j += 1
+        if start <= end:
+            result.append((start, end))
+    return result
+
+def count_intervals(intervals):
+    return sum(end - start + 1 for start, end in intervals)
+
+def rows_to_intervals(tile_rows):
+    return merge_intervals((tile_row, tile_row) for tile_row in tile_rows)
+
+def get_column_segments(rectangles):
+    """(first_column, last_column, rows) segments of the rectangles of a zoom level, the columns of a segment expect the same rows"""
+    boundaries = sorted({rectangle["startX"] for rectangle in rectangles} | {rectangle["endX"] + 1 for rectangle in rectangles})
+    segments = []
+    for first_column, next_column in zip(boundaries, boundaries[1:]):
+        rows = merge_intervals((rectangle["startY"], rectangle["endY"]) for rectangle in rectangles
+                               if rectangle["startX"] <= first_column <= rectangle["endX"])
+        if not rows:
+            continue
+        last_column = next_column - 1
+        # Neighbouring segments expecting the same rows are one segment
+        if segments and segments[-1][2] == rows and segments[-1][1] + 1 == first_column:
+            segments[-1] = (segments[-1][0], last_column, rows)
+        else:
+            segments.append((first_column, last_column, rows))
+    return segments
+
+class CompletenessCheck:
+    """Compares the tiles of a source tree or a GeoPackage with the availability of its layer.json, one interval per column"""
+
+    def __init__(self, source, layer_json_path=None, discovery_workers: int = DEFAULT_DISCOVERY_WORKERS):
+        self.source = source
+        self.layer_json_path = layer_json_path
+        self.discovery_workers = discovery_workers
+        self.is_gpkg = os.path.isfile(source)
+
+    def execute(self):
+        """Logs the report and returns True when no tile is missing or extra"""
+        start_time = time.time()
+        available = json.loads(self.read_layer_json()).get("available", [])
+        columns = self.read_gpkg_columns() if self.is_gpkg else self.read_tree_columns()
+        logger.info(f"Read the tiles of {self.source} in {time.time() - start_time:.1f} seconds")
+
+        summary = []
+        missing_ranges = []
+        extra_ranges = []
+        for zoom_level in sorted(set(range(len(available))) | set(columns)):
+            rectangles = available[zoom_level] if zoom_level < len(available) else []
+            expected, present, missing, extra = self.check_zoom_level(zoom_level, rectangles, columns.get(zoom_level, {}),
+                                                                      missing_ranges, extra_ranges)
+            summary.append([zoom_level, expected, present, missing, extra])
+
+        print(tabulate(summary, headers=["zoom_level", "expected", "present", "missing", "extra"], tablefmt="psql"))
+        self.report_ranges("Missing", missing_ranges)
+        self.report_ranges("Extra", extra_ranges)
+
+        is_complete = not missing_ranges and not extra_ranges
+        logger.info(f"Checked {self.source} in {time.time() - start_time:.1f} seconds: {'complete' if is_complete else 'incomplete'}")
+        return is_complete
+
+    def check_zoom_level(self, zoom_level, rectangles, zoom_columns, missing_ranges, extra_ranges):
+        present_columns = sorted(zoom_columns)
+        expected = present = missing = extra = 0
+        covered_columns = 0
+        segments = get_column_segments(rectangles)
+
+        for first_column, last_column, rows in segments:
+            rows_count = count_intervals(rows)
+            expected += (last_column - first_column + 1) * rows_count
+
+            first_index = bisect_left(present_columns, first_column)
+            last_index = bisect_right(present_columns, last_column)
+            covered_columns += last_index - first_index
+
+            # Runs of columns without any tile are missing as a whole
+            next_column = first_column
+            for tile_column in present_columns[first_index:last_index] + [last_column + 1]:
+                if tile_column > next_column:
+                    missing += (tile_column - next_column) * rows_count
+                    missing_ranges.extend((zoom_level, next_column, tile_column - 1, start, end) for start, end in rows)
+                next_column = tile_column + 1
+
+            for tile_column in present_columns[first_index:last_index]:
+                column_rows = zoom_columns[tile_column]
+                present += count_intervals(column_rows)
+                for start, end in subtract_intervals(rows, column_rows):
+                    missing += end - start + 1
+                    missing_ranges.append((zoom_level, tile_column, tile_column, start, end))
+                for start, end in subtract_intervals(column_rows, rows):
+                    extra += end - start + 1
+                    extra_ranges.append((zoom_level, tile_column, tile_column, start, end))
+
+        # Columns outside of every segment are extra as a whole
+        if covered_columns < len(present_columns):
+            for tile_column in present_columns:
+                if not any(first_column <= tile_column <= last_column for first_column, last_column, _ in segments):
+                    column_rows = zoom_columns[tile_column]
+                    present += count_intervals(column_rows)
+                    extra += count_intervals(column_rows)
+                    extra_ranges.extend((zoom_level, tile_column, tile_column, start, end) for start, end in column_rows)
+
+        return expected, present, missing, extra
+
+    def report_ranges(self, title, ranges):
+        if not ranges:
+            return
+
+        logger.info(f"{title} tiles ({len(ranges)} ranges{f', showing the first {MAX_REPORTED_RANGES}' if len(ranges) > MAX_REPORTED_RANGES else ''}):")
+        for zoom_level, first_column, last_column, first_row, last_row in ranges[:MAX_REPORTED_RANGES]:
+            columns = first_column if first_column == last_column else f"{first_column}-{last_column}"
+            rows = first_row if first_row == last_row else f"{first_row}-{last_row}"
+            logger.info(f"  {zoom_level}/{columns}/{rows}")
+
+    def read_layer_json(self):
+        if self.layer_json_path:
+            with open(self.layer_json_path, "r") as layer_json_file:
+                return layer_json_file.read()
+
+        if not self.is_gpkg:
+            with open(os.path.join(self.source, "layer.json"), "r") as layer_json_file:
+                return layer_json_file.read()
+
+        db_connection = sqlite3.connect(f'file:{self.source}?mode=ro', uri=True)
+        try:
+            result = db_connection.execute(f"SELECT data FROM {LAYER_JSON_TABLE} ORDER BY fid DESC LIMIT 1").fetchone()
+        finally:
+            db_connection.close()
+
+        if result is None:
+            raise RuntimeError(f"{self.source} has no layer.json, provide one to check against")
+        return result[0]
+
+    def read_gpkg_columns(self):
+        """Returns {zoom_level: {tile_column: row intervals}}, the intervals are computed by SQLite (gaps and islands)"""
+        columns = {}
+        db_connection = sqlite3.connect(f'file:{self.source}?mode=ro', uri=True)
+        try:
+            query = f"""
+            SELECT zoom_level, tile_column, MIN(tile_row), MAX(tile_row) FROM (
+                SELECT zoom_level, tile_column, tile_row,
+                       tile_row - ROW_NUMBER() OVER (PARTITION BY zoom_level, tile_column ORDER BY tile_row) AS island
+                FROM (SELECT DISTINCT zoom_level, tile_column, tile_row FROM {TERRAIN_TILES_TABLE})
+            )
+            GROUP BY zoom_level, tile_column, island
+            ORDER BY zoom_level, tile_column, MIN(tile_row)
+            """
+            for zoom_level, tile_column, first_row, last_row in db_connection.execute(query):
+                columns.setdefault(zoom_level, {}).setdefault(tile_column, []).append((first_row, last_row))
+        finally:
+            db_connection.close()
+
+        return columns
+
+    def read_tree_columns(self):
+        columns = {}
+        discovery = TileDiscovery(self.source, ["*.terrain"], self.discovery_workers)
+        for _, zoom_level, tile_column, files in discovery:
+            if zoom_level is None:
+                continue
+            tile_rows = [tile_row for _, tile_row in files if tile_row is not None]
+            if tile_rows:
+                columns.setdefault(zoom_level, {})[tile_column] = rows_to_intervals(tile_rows)
+
+        return columns
@@ -0,0 +1,77 @@
+import os, threading, time, logging
+
+# A file without a close event (platforms without IN_CLOSE_WRITE) is considered finished
+# once no event was seen for it during this many seconds
+DEFAULT_SETTLE_SECONDS = 2
+
+# How long an emitted file is remembered, later duplicated close/move events and metadata-only events for it are dropped
+EMITTED_TTL_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+def get_file_version(path):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+class EventCoalescer:
+    """Merges the watchdog events of a file and queues (file_path, time of its first event) once the file is finished"""
+
+    def __init__(self, event_queue, settle_seconds: float = DEFAULT_SETTLE_SECONDS):
+        self.event_queue = event_queue
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        # path -> (first event time, last event time) of files still being written
+        self.pending = {}
+        # path -> (emit time, (size, mtime_ns) when emitted) of recently emitted files
+        self.emitted = {}
+        self.dropped_events = 0
+
+    def file_changed(self, path):
+        """created / modified"""
+        now = time.monotonic()
+        with self.lock:
+            if path not in self.pending and path in self.emitted:
+                # chmod / xattr / access event of an emitted file, only a write (new size or mtime) is emitted again
+                if get_file_version(path) == self.emitted[path][1]:
+                    self.dropped_events += 1
+                    logger.debug(f"Dropping metadata event of {path}")
+                    return
+                del self.emitted[path]
+
+            first_event_at, _ = self.pending.get(path, (now, now))
+            self.pending[path] = (first_event_at, now)
+
+    def file_finished(self, path, is_new_version: bool = False):
+        """closed / moved into place"""
+        now = time.monotonic()
+        with self.lock:
+            # is_new_version: the path holds another file than the emitted one (a rename into place, a change found by
+            # polling), it is never a duplicate of it
+            if not is_new_version and path not in self.pending and path in self.emitted:
+                self.dropped_events += 1
+                logger.debug(f"Dropping duplicated event of {path}")
+                return
+
+            first_event_at, _ = self.pending.pop(path, (now, now))
+            self.emit(path, first_event_at, now)
+
+    def emit_settled(self):
+        """Emits the pending files that got no event for settle_seconds and forgets expired emitted files"""
+        now = time.monotonic()
+        with self.lock:
+            settled = [(path, first_event_at) for path, (first_event_at, last_event_at) in self.pending.items()
+                       if now - last_event_at >= self.settle_seconds]
+            for path, first_event_at in settled:
+                del self.pending[path]
+                self.emit(path, first_event_at, now)
+
+            expired = [path for path, (emitted_at, _) in self.emitted.items() if now - emitted_at >= EMITTED_TTL_SECONDS]
+            for path in expired:
+                del self.emitted[path]
+
+    def emit(self, path, first_event_at, now):
+        self.emitted[path] = (now, get_file_version(path))
+        self.event_queue.put((path, first_event_at))
@@ -0,0 +1,79 @@
+import os, sqlite3, threading, logging
+
+# Written in the output directory, next to layer.json
+MANIFEST_FILE_NAME = ".extract_manifest.sqlite"
+
+# Written tiles are recorded in transactions of this many tiles, so an interrupted run resumes close to where it stopped
+MANIFEST_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+def get_manifest_path(output_dir):
+    return os.path.join(output_dir, MANIFEST_FILE_NAME)
+
+def remove_manifest(output_dir):
+    """A full extraction rewrites the tiles without recording them, the entries of previous runs would be stale"""
+    manifest_path = get_manifest_path(output_dir)
+    for path in (manifest_path, f"{manifest_path}-wal", f"{manifest_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+            logger.debug(f"Removed {path}")
+
+class ExtractManifest:
+    """Size and content hash of the tiles written by incremental extractions, read one (zoom_level, tile_column) group at a time"""
+
+    def __init__(self, output_dir):
+        self.manifest_path = get_manifest_path(output_dir)
+        self.conn = None
+        self.pending_lock = threading.Lock()
+        self.pending_entries = []
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        # Waits for the other processes of a multi-process extraction
+        self.conn = sqlite3.connect(self.manifest_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode = wal;")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level INTEGER NOT NULL,
+            tile_column INTEGER NOT NULL,
+            tile_row INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (zoom_level, tile_column, tile_row)
+        ) WITHOUT ROWID;
+        """)
+        self.conn.commit()
+
+    def get_column_entries(self, zoom_level, tile_column):
+        """{tile_row: (size, hash)} of the tiles of a group recorded by previous runs"""
+        return {tile_row: (size, tile_hash) for tile_row, size, tile_hash in self.conn.execute(
+            "SELECT tile_row, size, hash FROM tiles WHERE zoom_level = ? AND tile_column = ?", (zoom_level, tile_column))}
+
+    def add(self, zoom_level, tile_column, tile_row, size, tile_hash):
+        """Called by the file writers once a tile is on disk"""
+        with self.pending_lock:
+            self.pending_entries.append((zoom_level, tile_column, tile_row, size, tile_hash))
+
+    def flush_if_due(self):
+        if len(self.pending_entries) >= MANIFEST_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self.pending_lock:
+            entries, self.pending_entries = self.pending_entries, []
+        if not entries:
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO tiles (zoom_level, tile_column, tile_row, size, hash) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(zoom_level, tile_column, tile_row) DO UPDATE SET size = excluded.size, hash = excluded.hash",
+                entries,
+            )
+
+    def close(self):
+        if self.conn:
+            self.flush()
+            self.conn.close()
+            self.conn = None
@@ -1,4 +1,4 @@
-import watchdog
+import watchdog, os
 from src.utils import patterns_match
 from src.constants import TEMP_FILES_PATTERNS
 import logging
@@ -6,24 +6,38 @@ import logging
 logger = logging.getLogger(__name__)
 
 class Handler(watchdog.events.PatternMatchingEventHandler):
-    def __init__(self, watch_patterns, event_queue):
+    """Forwards the events of tile files to an EventCoalescer, which puts every finished file on the event queue once"""
+
+    def __init__(self, watch_patterns, event_coalescer):
         super().__init__(patterns=watch_patterns, ignore_directories=True, case_sensitive=False)
-        self.event_queue = event_queue
+        self.event_coalescer = event_coalescer
         self.watch_patterns = watch_patterns
 
+    def is_tile_file(self, path):
+        # Match the file name, a pattern such as "layer.json" never matches the full path
+        filename = os.path.basename(path)
+        return not patterns_match(filename, TEMP_FILES_PATTERNS) and patterns_match(filename, self.watch_patterns)
+
     def on_moved(self, event):
         src_path, dest_path = event.src_path, event.dest_path
         logger.debug(f"File moved: {src_path} to {dest_path}")
-        if patterns_match(src_path, TEMP_FILES_PATTERNS) and patterns_match(dest_path, self.watch_patterns):
-            self.event_queue.put(dest_path)
+        if patterns_match(os.path.basename(src_path), TEMP_FILES_PATTERNS) and self.is_tile_file(dest_path):
+            self.event_coalescer.file_finished(dest_path, is_new_version=True)
 
     def on_created(self, event):
         src_path = event.src_path
         logger.debug(f"File created: {src_path}")
-        if not patterns_match(src_path, TEMP_FILES_PATTERNS) and patterns_match(src_path, self.watch_patterns):
-            self.event_queue.put(src_path)
+        if self.is_tile_file(src_path):
+            self.event_coalescer.file_changed(src_path)
+
+    def on_modified(self, event):
+        src_path = event.src_path
+        logger.debug(f"File modified: {src_path}")
+        if self.is_tile_file(src_path):
+            self.event_coalescer.file_changed(src_path)
 
     def on_closed(self, event):
         closed_file_path = event.src_path
         logger.debug(f"File closed: {closed_file_path}")
-        self.event_queue.put(closed_file_path)
+        if self.is_tile_file(closed_file_path):
+            self.event_coalescer.file_finished(closed_file_path)
@@ -1,41 +1,244 @@
-import os, logging, threading, time
+import os, logging, threading, time, sqlite3
 import concurrent.futures
-from src.constants import TERRAIN_TILES_TABLE, LAYER_JSON_TABLE
+from queue import Queue
+from osgeo import gdal
+from src.constants import TERRAIN_TILES_TABLE, LAYER_JSON_TABLE, ROWID_LAYOUT, CLUSTERED_LAYOUT
 from src.OGRConnectionPool import OGRConnectionPool
+from src.Metrics import Metrics
+from src.TileFilter import TileFilter
+from src.ExtractManifest import ExtractManifest, remove_manifest
+from src.utils import (read_gpkg_metadata, get_tiles_layout, is_deduplicated, get_tiles_data_select, get_tile_key, get_tile_key_range,
+                       get_tile_hash)
 
 logger = logging.getLogger(__name__)
 DEFAULT_WORKERS_NUMBER = 2
+
+# Tiles are handed to the file writers in chunks, through a queue of at most WRITE_QUEUE_SIZE chunks per writer
+WRITE_CHUNK_SIZE = 64
+WRITE_QUEUE_SIZE = 64
+
+# With processes, the table is split in this many key ranges per process, so the progress is reported as ranges complete
+PARTITIONS_PER_PROCESS = 4
+
+def split_tile_groups(tile_groups, partitions_count):
+    """Splits the ordered (zoom_level, tile_column, tiles_count) groups into contiguous ranges of about the same number of tiles"""
+    total_tiles = sum(tiles_count for _, _, tiles_count in tile_groups)
+    partitions = []
+    first_group = None
+    cumulative_tiles = 0
+    for zoom_level, tile_column, tiles_count in tile_groups:
+        if first_group is None:
+            first_group = (zoom_level, tile_column)
+        cumulative_tiles += tiles_count
+        if cumulative_tiles * partitions_count >= total_tiles * (len(partitions) + 1):
+            partitions.append((first_group, (zoom_level, tile_column)))
+            first_group = None
+
+    if first_group is not None:
+        partitions.append((first_group, (tile_groups[-1][0], tile_groups[-1][1])))
+
+    return partitions
+
+def has_tiles_index(gpkg_path):
+    """Whether an index of the tiles table starts with (zoom_level, tile_column, tile_row), like tiles_idx"""
+    db_connection = sqlite3.connect(f'file:{gpkg_path}?mode=ro', uri=True)
+    try:
+        for index in db_connection.execute(f"PRAGMA index_list({TERRAIN_TILES_TABLE})").fetchall():
+            columns = [column[2] for column in db_connection.execute(f"PRAGMA index_info('{index[1]}')")]
+            if columns[:3] == ["zoom_level", "tile_column", "tile_row"]:
+                return True
+        return False
+    finally:
+        db_connection.close()
+
+def extract_partition(gpkg_path, output_dir, workers, where_clauses, incremental):
+    """Runs in a worker process, extracts the tiles of a key range with its own read-only connection"""
+    gpkg_to_tiles = GpkgToTiles(gpkg_path, output_dir, workers, incremental=incremental)
+    gpkg_to_tiles.load_metadata()
+    if incremental:
+        gpkg_to_tiles.manifest = ExtractManifest(output_dir)
+        gpkg_to_tiles.manifest.open()
+
+    gpkg_ds = gdal.OpenEx(gpkg_path, gdal.OF_VECTOR | gdal.OF_READONLY)
+    if gpkg_ds is None:
+        raise FileNotFoundError(f"Couldn't open GPKG at {gpkg_path}")
+
+    try:
+        gpkg_to_tiles.extract_terrain_tiles(gpkg_ds, where_clauses)
+    finally:
+        gpkg_ds = None
+        if gpkg_to_tiles.manifest:
+            gpkg_to_tiles.manifest.close()
+
+    return (gpkg_to_tiles.metrics.tiles, gpkg_to_tiles.metrics.bytes, gpkg_to_tiles.metrics.processed, gpkg_to_tiles.skipped_count,
+            gpkg_to_tiles.errors_count)
+
 class GpkgToTiles:
-    def __init__(self, gpkg_path, output_dir, workers = DEFAULT_WORKERS_NUMBER):
+    def __init__(self, gpkg_path, output_dir, workers = DEFAULT_WORKERS_NUMBER, metrics: Metrics = None, processes: int = 0,
+                 tile_filter: TileFilter = None, incremental: bool = False):
         self.gpkg_path = gpkg_path
+        # The processes of extract_in_processes count into their own Metrics, their totals are added as their ranges complete
+        self.metrics = metrics or Metrics()
         self.output_dir = output_dir
         self.workers_count = DEFAULT_WORKERS_NUMBER if workers is None else workers
+        # With more than one process, every process extracts its own key ranges with workers_count file writers
+        self.processes = processes
+        # Extracts every tile when None
+        self.tile_filter = tile_filter
+        # Only writes the tiles that are missing or changed since the previous incremental run, see ExtractManifest
+        self.incremental = incremental
+        self.manifest = None
+        self.skipped_count = 0
         self.work_done = threading.Event()
+        self.tiles_layout = ROWID_LAYOUT
+        self.deduplicated = False
+        self.has_tiles_index = True
+        # One queue per writer, all the tiles of a (zoom_level, tile_column) group go to the same writer
+        self.write_queues = []
+        self.errors_lock = threading.Lock()
+        self.errors_count = 0
+
+    def extract_terrain_tiles(self, gpkg_ds, where_clauses=(None,)):
+        """Streams the tiles of each where clause to the file writers in tile order (rowid order without tiles_idx)"""
+        if self.tiles_layout == CLUSTERED_LAYOUT or not self.has_tiles_index:
+            # Clustered fids are the packed tile keys, the rowid order is the tile order. Without tiles_idx, the rowid
+            # order is the only one SQLite can stream, any other would sort the whole table and its blobs first
+            order_by = "t.fid"
+        else:
+            # Served by tiles_idx, which also holds the rowid: duplicated tiles come oldest first, only the newest is written
+            order_by = "t.zoom_level, t.tile_column, t.tile_row, t.fid"
+
+        self.write_queues = [Queue(WRITE_QUEUE_SIZE) for _ in range(self.workers_count)]
+        # Chunks waiting for the writers, the writers' backpressure
+        self.metrics.add_gauge("write_queue", lambda: sum(write_queue.qsize() for write_queue in self.write_queues))
+        writers = [threading.Thread(target=self.write_loop, args=(write_queue,), name=f"tile-writer-{i}", daemon=True)
+                   for i, write_queue in enumerate(self.write_queues)]
+        for writer in writers:
+            writer.start()
 
-    def extract_terrain_tiles(self, tile_group, gpkg_ds):
         try:
-            zoom_level, tile_column = tile_group
-            # Construct the directory path based on zoom level and tile column
-            tile_dir = os.path.join(self.output_dir, str(zoom_level), str(tile_column))
-            os.makedirs(tile_dir, exist_ok=True)
-            tiles_data_select = f"SELECT tile_row, tile_data FROM {TERRAIN_TILES_TABLE} WHERE zoom_level={zoom_level} AND tile_column={tile_column}"
-            res = gpkg_ds.ExecuteSQL(tiles_data_select)
-
-            for feature in res:
-                tile_row = feature.GetField("tile_row")
-                tile_data = feature.GetFieldAsBinary("tile_data")
-                tile_filename = os.path.join(tile_dir, f"{tile_row}.terrain")
-                logger.debug(f"processing {tile_filename}")
-                with open(tile_filename, 'wb') as tile_file:
-                    tile_file.write(tile_data)
-            return True
-        except Exception as e:
-            logger.error(e)
+            for where in where_clauses:
+                with self.metrics.time("query"):
+                    res = gpkg_ds.ExecuteSQL(f"{get_tiles_data_select(self.deduplicated, where)} ORDER BY {order_by}")
+
+                try:
+                    current_group = None
+                    writer_index = 0
+                    tile_dir = None
+                    manifest_entries = {}
+                    # Pending chunk of every writer. A group always goes to the same writer, so the duplicated rows of a
+                    # tile are written by one writer, in row order
+                    chunks = [[] for _ in self.write_queues]
+                    # (writer_index, tile) of the previous row, held back until the next row: when it is a newer row of the
+                    # same tile, only that one is written
+                    previous_tile = None
+                    for feature in res:
+                        zoom_level = feature.GetField("zoom_level")
+                        tile_column = feature.GetField("tile_column")
+                        if (zoom_level, tile_column) != current_group:
+                            current_group = (zoom_level, tile_column)
+                            writer_index = hash(current_group) % len(self.write_queues)
+                            tile_dir = os.path.join(self.output_dir, str(zoom_level), str(tile_column))
+                            os.makedirs(tile_dir, exist_ok=True)
+                            if self.manifest:
+                                manifest_entries = self.manifest.get_column_entries(zoom_level, tile_column)
+                                self.manifest.flush_if_due()
+
+                        tile_row = feature.GetField("tile_row")
+                        tile_filename = os.path.join(tile_dir, f"{tile_row}.terrain")
+                        tile = (tile_filename, feature.GetFieldAsBinary("tile_data"), (zoom_level, tile_column, tile_row),
+                                manifest_entries.get(tile_row))
+                        if previous_tile is not None:
+                            if previous_tile[1][2] == tile[2]:
+                                # Superseded duplicated row
+                                self.metrics.add_processed()
+                            else:
+                                self.queue_tile(chunks, *previous_tile)
+                        previous_tile = (writer_index, tile)
+
+                    if previous_tile is not None:
+                        self.queue_tile(chunks, *previous_tile)
+                    for write_queue, chunk in zip(self.write_queues, chunks):
+                        if chunk:
+                            write_queue.put(chunk)
+                finally:
+                    gpkg_ds.ReleaseResultSet(res)
+        finally:
+            for write_queue in self.write_queues:
+                write_queue.put(None)
+            for writer in writers:
+                writer.join()
+            if self.manifest:
+                self.manifest.flush()
+
+    def queue_tile(self, chunks, writer_index, tile):
+        chunk = chunks[writer_index]
+        chunk.append(tile)
+        if len(chunk) >= WRITE_CHUNK_SIZE:
+            self.write_queues[writer_index].put(chunk)
+            chunks[writer_index] = []
+
+    def is_unchanged(self, tile_filename, tile_data, tile_hash, manifest_entry):
+        """Whether the output file already holds tile_data, trusting the manifest entry of the tile when there is one"""
+        try:
+            size = os.stat(tile_filename).st_size
+        except FileNotFoundError:
+            return False
+
+        if size != len(tile_data):
             return False
+        if manifest_entry is not None:
+            return manifest_entry == (size, tile_hash)
+
+        # Written by a run without a manifest, compare the contents once
+        with open(tile_filename, 'rb') as tile_file:
+            return tile_file.read() == tile_data
+
+    def write_loop(self, write_queue):
+        # Without tiles_idx the duplicated rows of a tile aren't adjacent, the manifest entry read before the first of them
+        # was written is stale for the next ones
+        written_keys = set() if self.manifest and self.tiles_layout == ROWID_LAYOUT and not self.has_tiles_index else None
+        while True:
+            chunk = write_queue.get()
+            if chunk is None:
+                return
+
+            for tile_filename, tile_data, tile_key, manifest_entry in chunk:
+                try:
+                    logger.debug(f"processing {tile_filename}")
+                    tile_hash = None
+                    if written_keys is not None and tile_key in written_keys:
+                        manifest_entry = None
+                    if self.manifest:
+                        tile_hash = get_tile_hash(tile_data)
+                        with self.metrics.time("compare"):
+                            unchanged = self.is_unchanged(tile_filename, tile_data, tile_hash, manifest_entry)
+                        if unchanged:
+                            if manifest_entry is None:
+                                self.manifest.add(*tile_key, len(tile_data), tile_hash)
+                            self.metrics.add_processed()
+                            with self.errors_lock:
+                                self.skipped_count += 1
+                            continue
+
+                    with self.metrics.time("write"), open(tile_filename, 'wb') as tile_file:
+                        tile_file.write(tile_data)
+                    if self.manifest:
+                        self.manifest.add(*tile_key, len(tile_data), tile_hash)
+                    if written_keys is not None:
+                        written_keys.add(tile_key)
+                    self.metrics.add_tiles(1, len(tile_data))
+                    self.metrics.add_processed()
+                except Exception as e:
+                    logger.error(f"Error writing {tile_filename}: {e}")
+                    with self.errors_lock:
+                        self.errors_count += 1
 
     def extract_layer_json(self, connections_pool: OGRConnectionPool):
-        gpkg_ds = connections_pool.get_connection()
+        with connections_pool.connection() as gpkg_ds:
+            self.write_layer_json(gpkg_ds)
 
+    def write_layer_json(self, gpkg_ds):
         try:
             layer = gpkg_ds.GetLayer(LAYER_JSON_TABLE)
             if layer:
@@ -49,34 +252,148 @@ class GpkgToTiles:
                     layer_json_file.write(layer_json_data)         
         except Exception as e:
             logger.warning(f'Problem extracting layer.json from gpkg {e}')
-            
-        connections_pool.release_connection(gpkg_ds)
 
-    def process_tile_group(self,group, connections_pool):
-      gpkg_ds = connections_pool.get_connection()
-      try:
-          self.extract_terrain_tiles(group, gpkg_ds)
-      finally:
-          connections_pool.release_connection(gpkg_ds)
+    def load_metadata(self):
+        metadata = read_gpkg_metadata(self.gpkg_path)
+        self.tiles_layout = get_tiles_layout(metadata)
+        self.deduplicated = is_deduplicated(metadata)
+        logger.debug(f"{self.gpkg_path} uses the {self.tiles_layout} layout{' with deduplication' if self.deduplicated else ''}")
+
+        self.has_tiles_index = has_tiles_index(self.gpkg_path)
+        if self.tiles_layout != CLUSTERED_LAYOUT and not self.has_tiles_index:
+            logger.warning(f"{self.gpkg_path} has no (zoom_level, tile_column, tile_row) index (e.g. written by --dump), the tiles "
+                           f"are extracted in rowid order and filters scan the whole table. Create it with: --execute_sql {self.gpkg_path} "
+                           f"\"CREATE INDEX tiles_idx ON {TERRAIN_TILES_TABLE} (zoom_level, tile_column, tile_row)\"")
+
+    def get_partition_where(self, first_group, last_group):
+        first_zoom_level, first_tile_column = first_group
+        last_zoom_level, last_tile_column = last_group
+        if self.tiles_layout == CLUSTERED_LAYOUT:
+            return f"t.fid BETWEEN {get_tile_key(first_zoom_level, first_tile_column, 0)} AND {get_tile_key_range(last_zoom_level, last_tile_column)[1]}"
+
+        return (f"t.zoom_level BETWEEN {first_zoom_level} AND {last_zoom_level} "
+                f"AND (t.zoom_level > {first_zoom_level} OR t.tile_column >= {first_tile_column}) "
+                f"AND (t.zoom_level < {last_zoom_level} OR t.tile_column <= {last_tile_column})")
+
+    def get_where_clauses(self):
+        """Disjoint conditions selecting the tiles to extract, (None,) for the whole table"""
+        if self.tile_filter is None:
+            return (None,)
+
+        db_connection = sqlite3.connect(f'file:{self.gpkg_path}?mode=ro', uri=True)
+        try:
+            # Bounds the zoom levels of a bbox without zoom ranges, an index lookup
+            max_zoom_level = db_connection.execute(f"SELECT MAX(zoom_level) FROM {TERRAIN_TILES_TABLE}").fetchone()[0]
+        finally:
+            db_connection.close()
+
+        if max_zoom_level is None:
+            return []
+        return self.tile_filter.get_where_clauses(self.tiles_layout, max_zoom_level)
+
+    def count_tiles(self, where_clauses):
+        db_connection = sqlite3.connect(f'file:{self.gpkg_path}?mode=ro', uri=True)
+        try:
+            return sum(db_connection.execute(f"SELECT COUNT(*) FROM {TERRAIN_TILES_TABLE} t{f' WHERE {where}' if where else ''}").fetchone()[0]
+                       for where in where_clauses)
+        finally:
+            db_connection.close()
+
+    def get_tile_groups(self, where_clauses):
+        """Ordered (zoom_level, tile_column, tiles_count) of every group holding selected tiles, counted on tiles_idx"""
+        groups_counts = {}
+        db_connection = sqlite3.connect(f'file:{self.gpkg_path}?mode=ro', uri=True)
+        try:
+            for where in where_clauses:
+                query = (f"SELECT zoom_level, tile_column, COUNT(*) FROM {TERRAIN_TILES_TABLE} t{f' WHERE {where}' if where else ''} "
+                         f"GROUP BY zoom_level, tile_column")
+                for zoom_level, tile_column, tiles_count in db_connection.execute(query):
+                    groups_counts[(zoom_level, tile_column)] = groups_counts.get((zoom_level, tile_column), 0) + tiles_count
+        finally:
+            db_connection.close()
+
+        return [(zoom_level, tile_column, tiles_count) for (zoom_level, tile_column), tiles_count in sorted(groups_counts.items())]
+
+    def extract_in_processes(self, where_clauses):
+        tile_groups = self.get_tile_groups(where_clauses)
+        if not tile_groups:
+            return
+
+        partitions = split_tile_groups(tile_groups, self.processes * PARTITIONS_PER_PROCESS)
+        self.metrics.add_discovered(sum(tiles_count for _, _, tiles_count in tile_groups))
+        self.metrics.discovery_done = True
+        logger.info(f"Extracting {len(partitions)} key ranges with {self.processes} processes of {self.workers_count} writers")
+
+        failed_partitions = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = {}
+            for first_group, last_group in partitions:
+                partition_where = self.get_partition_where(first_group, last_group)
+                partition_where_clauses = [partition_where if where is None else f"({partition_where}) AND ({where})" for where in where_clauses]
+                future = executor.submit(extract_partition, self.gpkg_path, self.output_dir, self.workers_count, partition_where_clauses,
+                                         self.incremental)
+                futures[future] = (first_group, last_group)
+
+            for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                first_group, last_group = futures[future]
+                try:
+                    tiles_count, tiles_size, processed_count, skipped_count, errors_count = future.result()
+                except Exception as e:
+                    failed_partitions += 1
+                    logger.error(f"Extracting {first_group} to {last_group} failed: {e}")
+                    continue
+
+                self.metrics.add_tiles(tiles_count, tiles_size)
+                self.metrics.add_processed(processed_count)
+                self.skipped_count += skipped_count
+                self.errors_count += errors_count
+                logger.info(f"Extracted {tiles_count} tiles{f' ({skipped_count} unchanged)' if self.incremental else ''} "
+                            f"from {first_group} to {last_group} ({done_count}/{len(partitions)} key ranges)")
+
+        if failed_partitions:
+            raise RuntimeError(f"{failed_partitions} of {len(partitions)} key ranges failed")
 
     def execute(self):
-        connections_pool = OGRConnectionPool(os.cpu_count(), self.gpkg_path)
+        # A single connection streams the table, the parallelism is in the file writers (and the processes)
+        connections_pool = OGRConnectionPool(1, self.gpkg_path)
         startTime = time.time()
 
         try:
+            self.load_metadata()
             self.extract_layer_json(connections_pool)
-            tile_groups = self.get_tile_groups(connections_pool)
-            
-            for group in tile_groups:
-                self.process_tile_group(group, connections_pool)
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers_count) as executor:
-                futures = []
-                for group in tile_groups:
-                    future = executor.submit(self.process_tile_group, group, connections_pool)
-                    futures.append(future)
-
-                concurrent.futures.wait(futures, timeout=None)
+
+            where_clauses = self.get_where_clauses()
+            if self.tile_filter is not None:
+                logger.info(f"The filters select {len(where_clauses)} tile ranges")
+
+            if not self.incremental:
+                remove_manifest(self.output_dir)
+            else:
+                # Created before the processes open it, with processes
+                self.manifest = ExtractManifest(self.output_dir)
+                self.manifest.open()
+
+            if self.processes > 1:
+                # Worker processes open their own connections, don't let them inherit these
+                connections_pool.close_all_connections()
+                if self.manifest:
+                    self.manifest.close()
+                    self.manifest = None
+                self.extract_in_processes(where_clauses)
+                if self.errors_count:
+                    raise RuntimeError(f"{self.errors_count} tiles could not be written")
+                return
+
+            with connections_pool.connection() as gpkg_ds:
+                if self.tile_filter is None:
+                    self.metrics.add_discovered(gpkg_ds.GetLayerByName(TERRAIN_TILES_TABLE).GetFeatureCount())
+                else:
+                    self.metrics.add_discovered(self.count_tiles(where_clauses))
+                self.metrics.discovery_done = True
+                self.extract_terrain_tiles(gpkg_ds, where_clauses)
+
+            if self.errors_count:
+                raise RuntimeError(f"{self.errors_count} tiles could not be written")
         except Exception as e:
             logger.error(e)
             exit(1)
@@ -84,20 +401,8 @@ class GpkgToTiles:
         finally:
             endTime = time.time()
             connections_pool.close_all_connections()
+            if self.manifest:
+                self.manifest.close()
+            if self.incremental:
+                logger.info(f"{self.skipped_count} tiles were unchanged and not written")
             logger.info(f"Extraction Done in {endTime - startTime} Seconds ! Files at {self.output_dir}")
-
-    def get_tile_groups(self, connections_pool: OGRConnectionPool):
-      gpkg_ds = connections_pool.get_connection()
-
-      tiles_groups_select = f"SELECT DISTINCT zoom_level, tile_column FROM {TERRAIN_TILES_TABLE}"
-      res = gpkg_ds.ExecuteSQL(tiles_groups_select)
-
-      tile_groups = set()
-      for feature in res:
-          zoom_level = feature.GetField("zoom_level")
-          tile_column = feature.GetField("tile_column")
-          tile_groups.add((zoom_level, tile_column))
-      
-      connections_pool.release_connection(gpkg_ds)
-      
-      return list(tile_groups)
\ No newline at end of file
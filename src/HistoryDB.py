@@ -1,15 +1,46 @@
-import sqlite3, logging
+import sqlite3, logging, time
+from collections import Counter
 
 MAX_BATCH_SIZE = 5000
 
+# Tiles are not ingested in ctime order (event settling, batches, queue lag), a tile changed this long before the newest
+# ctime of its directory may still have been queued when the service stopped. The tiles ingested in that window are
+# recorded one by one (boundary_tiles), so a catch-up can tell them from the ones that were lost
+HISTORY_CTIME_MARGIN_SECONDS = 60
+
 logger = logging.getLogger(__name__)
+
+def get_directory_key(directory):
+    # "zoom/column" directories are packed into one int, which takes a fraction of the memory of the string
+    zoom_level, _, tile_column = directory.partition("/")
+    if zoom_level.isdigit() and tile_column.isdigit():
+        return (int(zoom_level) << 32) | int(tile_column)
+    return directory
+
 class HistoryDatabase:
-    def __init__(self, db_file_path: str):
+    def __init__(self, db_file_path: str, auto_flush: bool = True):
         self.db_file_path = db_file_path
+        # When disabled, the owner is responsible for calling flush(), e.g. right after
+        # committing the matching GeoPackage transaction.
+        self.auto_flush = auto_flush
         self.conn = None
         self.cursor = None
-        self.updates_batch = []
+        # directory -> tiles added since the last flush, aggregated in memory
+        self.updates_batch = Counter()
+        # directory -> newest ctime of the tiles added since the last flush
+        self.ctimes_batch = {}
+        # (directory, tile_row) -> ctime of the tiles added since the last flush
+        self.tile_ctimes_batch = {}
+        self.pending_updates = 0
+        self.flush_count = 0
+        self.total_flush_seconds = 0
+        self.max_flush_seconds = 0
+        # Optional callable receiving the duration of every flush, in seconds
+        self.on_flush = None
+        # Keys of every recorded directory, including the ones still waiting in updates_batch
+        self.directories = set()
         self.init_history_db()
+        self.load_directories()
 
     def init_history_db(self):
         self.conn = sqlite3.connect(self.db_file_path)
@@ -19,35 +50,111 @@ class HistoryDatabase:
         CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY,
             directory TEXT NOT NULL,
-            tiles_count INTEGER NOT NULL
+            tiles_count INTEGER NOT NULL,
+            max_ctime_ns INTEGER
         );
         """
         self.cursor.execute(create_history_table_query)
-        self.cursor.execute(
-            "CREATE INDEX IF NOT EXISTS idx_directory ON history (directory);"
-        )
         self.cursor.execute("PRAGMA journal_mode = wal;")
+        # Older history databases only counted the tiles, their directories have no ctime watermark
+        if "max_ctime_ns" not in [column[1] for column in self.cursor.execute("PRAGMA table_info(history);")]:
+            self.cursor.execute("ALTER TABLE history ADD COLUMN max_ctime_ns INTEGER;")
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS boundary_tiles (
+            directory TEXT NOT NULL,
+            tile_row INTEGER NOT NULL,
+            ctime_ns INTEGER NOT NULL,
+            PRIMARY KEY (directory, tile_row)
+        ) WITHOUT ROWID;
+        """)
+        self.create_unique_directory_index()
         self.conn.commit()
 
-    def update_history(self, directory):
-        self.updates_batch.append(directory)
+    def create_unique_directory_index(self):
+        # The UPSERT flush needs a unique directory, older history databases only had a plain index
+        try:
+            self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_directory_unique ON history (directory);")
+        except sqlite3.IntegrityError:
+            logger.info("Merging duplicated history directories...")
+            self.cursor.execute("""
+            UPDATE history SET tiles_count = (SELECT SUM(h.tiles_count) FROM history h WHERE h.directory = history.directory),
+                               max_ctime_ns = (SELECT MAX(h.max_ctime_ns) FROM history h WHERE h.directory = history.directory)
+            WHERE id IN (SELECT MIN(id) FROM history GROUP BY directory);
+            """)
+            self.cursor.execute("DELETE FROM history WHERE id NOT IN (SELECT MIN(id) FROM history GROUP BY directory);")
+            self.cursor.execute("CREATE UNIQUE INDEX idx_directory_unique ON history (directory);")
+
+        self.cursor.execute("DROP INDEX IF EXISTS idx_directory;")
+
+    def load_directories(self):
+        start_time = time.time()
+
+        for (directory,) in self.conn.execute("SELECT directory FROM history"):
+            self.directories.add(get_directory_key(directory))
+
+        logger.debug(f"Loaded {len(self.directories)} history directories in {time.time() - start_time:.3f} seconds")
+
+    def update_history(self, directory, ctime_ns=None, tile_row=None):
+        self.updates_batch[directory] += 1
+        if ctime_ns is not None:
+            if ctime_ns > self.ctimes_batch.get(directory, 0):
+                self.ctimes_batch[directory] = ctime_ns
+            if tile_row is not None and ctime_ns > self.tile_ctimes_batch.get((directory, tile_row), 0):
+                self.tile_ctimes_batch[(directory, tile_row)] = ctime_ns
+        self.pending_updates += 1
+        self.directories.add(get_directory_key(directory))
 
-        if len(self.updates_batch) >= MAX_BATCH_SIZE:
-            self.insert_or_update_history_entry_batch(self.updates_batch)
-            self.updates_batch = []
+        if self.auto_flush and self.pending_updates >= MAX_BATCH_SIZE:
+            self.flush()
 
-    def insert_or_update_history_entry_batch(self, entries):
+    def flush(self):
+        if self.updates_batch:
+            start_time = time.perf_counter()
+            self.insert_or_update_history_entry_batch([(directory, tiles_count, self.ctimes_batch.get(directory))
+                                                       for directory, tiles_count in self.updates_batch.items()],
+                                                      self.get_boundary_tile_entries())
+
+            flush_seconds = time.perf_counter() - start_time
+            self.flush_count += 1
+            self.total_flush_seconds += flush_seconds
+            self.max_flush_seconds = max(self.max_flush_seconds, flush_seconds)
+            if self.on_flush:
+                self.on_flush(flush_seconds)
+            logger.debug(f"Flushed {self.pending_updates} history updates of {len(self.updates_batch)} directories in {flush_seconds * 1000:.2f} ms")
+
+            self.updates_batch = Counter()
+            self.ctimes_batch = {}
+            self.tile_ctimes_batch = {}
+            self.pending_updates = 0
+
+    def get_boundary_tile_entries(self):
+        """(directory, tile_row, ctime_ns) of the batched tiles, except the ones already out of the margin of their directory"""
+        margin_ns = HISTORY_CTIME_MARGIN_SECONDS * 10**9
+        return [(directory, tile_row, ctime_ns) for (directory, tile_row), ctime_ns in self.tile_ctimes_batch.items()
+                if ctime_ns >= self.ctimes_batch[directory] - margin_ns]
+
+    def insert_or_update_history_entry_batch(self, entries, tile_entries=()):
+        """entries are (directory, tiles_count, max_ctime_ns or None) tuples, tile_entries (directory, tile_row, ctime_ns) tuples"""
         try:
             self.conn.execute("BEGIN TRANSACTION;")
-            for directory in entries:
-                # Check if the record already exists
-                existing_record = self.cursor.execute("SELECT * FROM history WHERE directory = ?", (directory,)).fetchone()
-                
-                if existing_record:
-                    self.cursor.execute("UPDATE history SET tiles_count = tiles_count + 1 WHERE directory = ?", (directory,))
-                else:
-                    self.cursor.execute("INSERT INTO history (directory, tiles_count) VALUES (?, 1)", (directory,))
-            
+            self.cursor.executemany(
+                "INSERT INTO history (directory, tiles_count, max_ctime_ns) VALUES (?, ?, ?) "
+                "ON CONFLICT(directory) DO UPDATE SET tiles_count = tiles_count + excluded.tiles_count, "
+                "max_ctime_ns = MAX(COALESCE(max_ctime_ns, excluded.max_ctime_ns), COALESCE(excluded.max_ctime_ns, max_ctime_ns))",
+                entries,
+            )
+            if tile_entries:
+                self.cursor.executemany(
+                    "INSERT INTO boundary_tiles (directory, tile_row, ctime_ns) VALUES (?, ?, ?) "
+                    "ON CONFLICT(directory, tile_row) DO UPDATE SET ctime_ns = MAX(ctime_ns, excluded.ctime_ns)",
+                    tile_entries,
+                )
+                # Only the tiles within the margin of the (possibly advanced) watermark are kept
+                self.cursor.executemany(
+                    "DELETE FROM boundary_tiles WHERE directory = ?1 "
+                    "AND ctime_ns < (SELECT max_ctime_ns FROM history WHERE directory = ?1) - ?2",
+                    [(directory, HISTORY_CTIME_MARGIN_SECONDS * 10**9) for directory in {entry[0] for entry in tile_entries}],
+                )
             self.conn.execute("COMMIT;")
         except Exception as e:
             self.conn.execute("ROLLBACK;")
@@ -55,21 +162,47 @@ class HistoryDatabase:
             import traceback
             traceback.print_exc()
 
+    def merge_history(self, other_db_file_path):
+        """Adds the tiles counts recorded in another history database to this one"""
+        self.flush()
+
+        other_conn = sqlite3.connect(other_db_file_path)
+        try:
+            entries = other_conn.execute("SELECT directory, tiles_count, max_ctime_ns FROM history").fetchall()
+            tile_entries = other_conn.execute("SELECT directory, tile_row, ctime_ns FROM boundary_tiles").fetchall()
+        finally:
+            other_conn.close()
+
+        for directory, *_ in entries:
+            self.directories.add(get_directory_key(directory))
+
+        self.insert_or_update_history_entry_batch(entries, tile_entries)
+
     def has_directory(self, directory):
-      try:
-          result = self.cursor.execute("SELECT 1 FROM history WHERE directory = ? LIMIT 1", (directory,)).fetchone()
-          
-          return result is not None
+        return get_directory_key(directory) in self.directories
+
+    def get_ctime_watermark(self, directory):
+        """Newest ctime of the tiles recorded for a directory, None when unknown (recorded by an older version)"""
+        result = self.conn.execute("SELECT max_ctime_ns FROM history WHERE directory = ?", (directory,)).fetchone()
+        ctimes = [ctime_ns for ctime_ns in (result[0] if result else None, self.ctimes_batch.get(directory)) if ctime_ns is not None]
+        return max(ctimes) if ctimes else None
 
-      except Exception as e:
-          print(f"Error checking if directory exists: {e}")
-          import traceback
-          traceback.print_exc()
-          return False
+    def get_boundary_tiles(self, directory):
+        """{tile_row: ctime_ns} of the tiles ingested within the margin of the watermark of a directory"""
+        boundary_tiles = dict(self.conn.execute("SELECT tile_row, ctime_ns FROM boundary_tiles WHERE directory = ?", (directory,)))
+        if directory not in self.ctimes_batch:
+            return boundary_tiles
+        for (batch_directory, tile_row), ctime_ns in self.tile_ctimes_batch.items():
+            if batch_directory == directory and ctime_ns > boundary_tiles.get(tile_row, 0):
+                boundary_tiles[tile_row] = ctime_ns
+        return boundary_tiles
 
     def close_connection(self):
         if self.conn:
-            if self.updates_batch:
-                self.insert_or_update_history_entry_batch(self.updates_batch)
+            self.flush()
             self.conn.close()
+            self.conn = None
+            if self.flush_count:
+                logger.info(f"History: {self.flush_count} flushes, {self.total_flush_seconds:.3f} seconds in total, "
+                            f"{self.total_flush_seconds / self.flush_count * 1000:.2f} ms average, {self.max_flush_seconds * 1000:.2f} ms max")
             logger.debug("Closed SQLite history database connection.")
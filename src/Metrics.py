@@ -0,0 +1,197 @@
+import os, sys, json, threading, time, logging
+
+JSON_FORMAT = "json"
+PROMETHEUS_FORMAT = "prometheus"
+METRICS_FORMATS = [JSON_FORMAT, PROMETHEUS_FORMAT]
+
+DEFAULT_METRICS_INTERVAL = 10
+
+# Upper bounds of the stage latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")]
+
+# Metric names prefix of the Prometheus textfile
+PROMETHEUS_PREFIX = "terrain"
+
+logger = logging.getLogger(__name__)
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, seconds):
+        index = 0
+        while seconds > LATENCY_BUCKETS[index]:
+            index += 1
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, None when it is above the last finite bucket"""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            cumulative += count
+            if count and cumulative >= rank:
+                return None if bound == float("inf") else bound
+        return None
+
+class StageTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start_time)
+
+class Metrics:
+    """Throughput, queue depths, stage latencies and ETA, main.py starts and closes it, TilesToGpkg and GpkgToTiles count into it"""
+
+    def __init__(self, output_path=None, output_format: str = JSON_FORMAT, interval: float = DEFAULT_METRICS_INTERVAL):
+        self.output_path = output_path
+        self.output_format = output_format
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.tiles = 0
+        self.bytes = 0
+        self.discovered = 0
+        self.processed = 0
+        self.discovery_done = False
+        self.counters_lock = threading.Lock()
+        self.stages = {}
+        self.gauges = {}
+        self.last_report = (self.started_at, 0, 0)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.output_path:
+            self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+            self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            # Final state of the run
+            self.emit()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.emit()
+            except Exception as e:
+                logger.warning(f"Error writing metrics to {self.output_path}: {e}")
+
+    def add_tiles(self, count, size):
+        with self.counters_lock:
+            self.tiles += count
+            self.bytes += size
+
+    def add_discovered(self, count=1):
+        with self.counters_lock:
+            self.discovered += count
+
+    def add_processed(self, count=1):
+        with self.counters_lock:
+            self.processed += count
+
+    def add_gauge(self, name, read_value):
+        """read_value is called from the metrics thread on every emit, e.g. a queue qsize"""
+        self.gauges[name] = read_value
+
+    def get_histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.get_histogram(stage).observe(seconds)
+
+    def time(self, stage):
+        """with metrics.time("insert"): ..."""
+        return StageTimer(self.get_histogram(stage))
+
+    def snapshot(self):
+        now = time.monotonic()
+        last_time, last_tiles, last_bytes = self.last_report
+        elapsed = max(now - last_time, 1e-9)
+        tiles, size = self.tiles, self.bytes
+        self.last_report = (now, tiles, size)
+
+        total_elapsed = max(now - self.started_at, 1e-9)
+        processed_rate = self.processed / total_elapsed
+        eta = None
+        if self.discovery_done and processed_rate > 0:
+            eta = max(self.discovered - self.processed, 0) / processed_rate
+
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": round(total_elapsed, 3),
+            "tiles": tiles,
+            "bytes": size,
+            "tiles_per_second": round((tiles - last_tiles) / elapsed, 1),
+            "bytes_per_second": round((size - last_bytes) / elapsed, 1),
+            "discovered": self.discovered,
+            "processed": self.processed,
+            "discovery_done": self.discovery_done,
+            "eta_seconds": None if eta is None else round(eta, 1),
+            "gauges": {name: read_value() for name, read_value in list(self.gauges.items())},
+            "stages": {
+                stage: {
+                    "count": histogram.count,
+                    "mean_seconds": histogram.sum / histogram.count if histogram.count else None,
+                    "p50_seconds": histogram.quantile(0.5),
+                    "p95_seconds": histogram.quantile(0.95),
+                    "p99_seconds": histogram.quantile(0.99),
+                }
+                for stage, histogram in list(self.stages.items())
+            },
+        }
+
+    def emit(self):
+        snapshot = self.snapshot()
+        if self.output_format == PROMETHEUS_FORMAT:
+            self.write_prometheus(snapshot)
+        elif self.output_path == "-":
+            print(json.dumps(snapshot), file=sys.stdout, flush=True)
+        else:
+            with open(self.output_path, "a") as metrics_file:
+                metrics_file.write(json.dumps(snapshot) + "\n")
+
+    def write_prometheus(self, snapshot):
+        lines = []
+        for name, metric_type in [("tiles", "counter"), ("bytes", "counter"), ("tiles_per_second", "gauge"), ("bytes_per_second", "gauge"),
+                                  ("discovered", "gauge"), ("processed", "gauge"), ("eta_seconds", "gauge")]:
+            if snapshot[name] is not None:
+                metric_name = f"{PROMETHEUS_PREFIX}_{name}_total" if metric_type == "counter" else f"{PROMETHEUS_PREFIX}_{name}"
+                lines.append(f"# TYPE {metric_name} {metric_type}")
+                lines.append(f"{metric_name} {snapshot[name]}")
+
+        if snapshot["gauges"]:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_gauge gauge")
+            lines.extend(f'{PROMETHEUS_PREFIX}_gauge{{name="{name}"}} {value}' for name, value in snapshot["gauges"].items())
+
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds histogram")
+        for stage, histogram in list(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, list(histogram.buckets)):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        # The collector must never read a half written file
+        temp_path = f"{self.output_path}.tmp"
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.output_path)
@@ -1,52 +1,159 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, List
+from contextlib import contextmanager
 from osgeo import gdal, ogr
-import threading
-from queue import Queue
+import threading, time, logging
+
+logger = logging.getLogger(__name__)
+
+class Lease:
+    def __init__(self, connection: ogr.DataSource, acquired_at: float):
+        self.connection = connection
+        self.acquired_at = acquired_at
+        # get_connection calls of the owning thread not released yet
+        self.depth = 1
 
 class OGRConnectionPool:
+    """Lazily opened GDAL datasets, at most max_connections, each used by one thread at a time and handed back to its last thread"""
+
     def __init__(self, max_connections: int, *args, **kwargs):
         self.max_connections: int = max_connections
         self.connection_args = args
         self.connection_kwargs = kwargs
-        self._pool: Queue = Queue(max_connections)
-        self._in_use: Dict[ogr.DataSource, int] = {}
-        self._lock: threading.Lock = threading.Lock()
-
-        for _ in range(max_connections):
-            connection = self._create_connection()
-            if connection is None:
-                raise FileNotFoundError(f"Couldn't create a connection to GPKG at {self.connection_args}")
-            self._pool.put(connection)
+        self._condition: threading.Condition = threading.Condition()
+        self._idle: List[ogr.DataSource] = []
+        self._leases: Dict[int, Lease] = {}
+        self._local = threading.local()
+        # Open connections, including the ones being opened
+        self._opened_count: int = 0
+        self._created_at: float = time.perf_counter()
+        self.total_opened: int = 0
+        self.acquisitions: int = 0
+        self.waits: int = 0
+        self.total_wait_seconds: float = 0
+        self.max_wait_seconds: float = 0
+        self.busy_seconds: float = 0
+        self.max_in_use: int = 0
 
     def _create_connection(self) -> ogr.DataSource:
         return gdal.OpenEx(*self.connection_args, **self.connection_kwargs)
 
-    def get_connection(self) -> Optional[ogr.DataSource]:
-        with self._lock:
-            if not self._pool.empty():
-                connection = self._pool.get()
-                self._in_use[connection] = self._in_use.get(connection, 0) + 1
-                return connection
-            else:
-                # Pool is empty
-                # Return connection from _is_use that has the lease connections
-                connection = min(self._in_use, key=self._in_use.get, default=None)
-                if connection:
-                    self._in_use[connection] += 1
-                    return connection
-                
+    def get_connection(self, timeout: Optional[float] = None) -> ogr.DataSource:
+        thread_id = threading.get_ident()
+        start_time = time.perf_counter()
+
+        with self._condition:
+            lease = self._leases.get(thread_id)
+            if lease is not None:
+                lease.depth += 1
+                return lease.connection
+
+            connection = self._wait_for_connection(start_time, timeout)
+
+        if connection is None:
+            # Opened outside of the lock, the other threads keep using the open connections meanwhile
+            try:
+                connection = self._create_connection()
+                if connection is None:
+                    raise FileNotFoundError(f"Couldn't create a connection to GPKG at {self.connection_args}")
+            except Exception:
+                with self._condition:
+                    self._opened_count -= 1
+                    self._condition.notify()
+                raise
+
+            with self._condition:
+                self.total_opened += 1
+
+        with self._condition:
+            wait_seconds = time.perf_counter() - start_time
+            self._leases[thread_id] = Lease(connection, time.perf_counter())
+            self.acquisitions += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            self.max_in_use = max(self.max_in_use, len(self._leases))
+
+        # Only the id, a reference would keep the dataset open after close_all_connections
+        self._local.connection_id = id(connection)
+        return connection
+
+    def _wait_for_connection(self, start_time: float, timeout: Optional[float]) -> Optional[ogr.DataSource]:
+        """Takes an idle connection, or returns None when a new one may be opened. Called with the lock held"""
+        waited = False
+        while True:
+            if self._idle:
+                last_connection_id = getattr(self._local, "connection_id", None)
+                for index, connection in enumerate(self._idle):
+                    if id(connection) == last_connection_id:
+                        return self._idle.pop(index)
+                return self._idle.pop()
+
+            if self._opened_count < self.max_connections:
+                self._opened_count += 1
                 return None
 
+            remaining = None if timeout is None else timeout - (time.perf_counter() - start_time)
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"No connection to {self.connection_args} was released within {timeout} seconds, "
+                                   f"all {self.max_connections} are in use")
+            if not waited:
+                waited = True
+                self.waits += 1
+            self._condition.wait(remaining)
+
     def release_connection(self, connection: ogr.DataSource) -> None:
-        with self._lock:
-            if connection in self._in_use:
-                self._in_use[connection] -= 1
-                if self._in_use[connection] == 0:
-                    del self._in_use[connection]
-                    self._pool.put(connection)
+        with self._condition:
+            thread_id = threading.get_ident()
+            lease = self._leases.get(thread_id)
+            if lease is None or lease.connection is not connection:
+                # Released by another thread than the one that got it
+                thread_id = next((owner for owner, owner_lease in self._leases.items() if owner_lease.connection is connection), None)
+                if thread_id is None:
+                    return
+                lease = self._leases[thread_id]
+
+            lease.depth -= 1
+            if lease.depth > 0:
+                return
+
+            del self._leases[thread_id]
+            self.busy_seconds += time.perf_counter() - lease.acquired_at
+            self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """with pool.connection() as gpkg_ds: ..."""
+        connection = self.get_connection(timeout)
+        try:
+            yield connection
+        finally:
+            self.release_connection(connection)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._condition:
+            elapsed = max(time.perf_counter() - self._created_at, 1e-9)
+            busy_seconds = self.busy_seconds + sum(time.perf_counter() - lease.acquired_at for lease in self._leases.values())
+            return {
+                "max_connections": self.max_connections,
+                "open": self._opened_count,
+                "in_use": len(self._leases),
+                "max_in_use": self.max_in_use,
+                "total_opened": self.total_opened,
+                "acquisitions": self.acquisitions,
+                "waits": self.waits,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+                # Share of the pool capacity held by threads since the pool was created
+                "utilization": round(busy_seconds / (elapsed * self.max_connections), 3),
+            }
 
     def close_all_connections(self) -> None:
-        with self._lock:
-            while not self._pool.empty():
-                connection = self._pool.get()
-                connection = None  # Close the connection
\ No newline at end of file
+        """Closes the idle connections, the ones in use are kept until released. The pool can still open new ones"""
+        with self._condition:
+            closed_count = len(self._idle)
+            self._opened_count -= closed_count
+            # Dropping the last reference closes the dataset
+            self._idle = []
+
+        if self.acquisitions:
+            logger.debug(f"Closed {closed_count} connections to {self.connection_args[0] if self.connection_args else None}, pool stats: {self.get_stats()}")
@@ -0,0 +1,234 @@
+import os, sqlite3, threading, time, logging
+from src.utils import patterns_match
+from src.constants import TEMP_FILES_PATTERNS
+
+DEFAULT_POLL_INTERVAL = 10
+
+# A directory modified this recently is scanned again on the next poll, a second change within
+# the same mtime tick (or a server clock ahead of ours) would otherwise go unnoticed
+RACY_SECONDS = 2
+
+logger = logging.getLogger(__name__)
+
+class DirectoryState:
+    def __init__(self, mtime_ns=0, size=0, entries=0, watermark_ns=0):
+        # mtime and size of the directory when it was last listed
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.entries = entries
+        # Files changed (ctime) before the watermark were already emitted, emitted maps the names of the
+        # files emitted at or after it to their ctime
+        self.watermark_ns = watermark_ns
+        self.emitted = {}
+        self.children = set()
+
+class PollingWatcher:
+    """Watches a tree by polling its directories instead of inotify (network mounts), with the interface of a watchdog observer"""
+
+    def __init__(self, source_dir, patterns, event_coalescer, snapshot_path, interval: float = DEFAULT_POLL_INTERVAL):
+        self.source_dir = os.path.normpath(source_dir)
+        self.patterns = patterns
+        self.event_coalescer = event_coalescer
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.directories = {}
+        # file path -> (directory, size, ctime_ns) of files waiting for their size to settle
+        self.pending_files = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.conn = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="polling-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self):
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        # The sqlite connection belongs to the polling thread
+        self.open_snapshot()
+        try:
+            while not self.stop_event.is_set():
+                start_time = time.monotonic()
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error(f"Error polling {self.source_dir}: {e}")
+                    import traceback
+                    traceback.print_exc()
+                self.stop_event.wait(max(self.interval - (time.monotonic() - start_time), 0))
+        finally:
+            self.conn.close()
+            self.conn = None
+
+    def open_snapshot(self):
+        self.conn = sqlite3.connect(self.snapshot_path)
+        self.conn.execute("PRAGMA journal_mode = wal;")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS directories (
+            path TEXT PRIMARY KEY,
+            parent TEXT,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            entries INTEGER NOT NULL,
+            watermark_ns INTEGER NOT NULL
+        );
+        """)
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS emitted_files (
+            directory TEXT NOT NULL,
+            name TEXT NOT NULL,
+            ctime_ns INTEGER NOT NULL,
+            PRIMARY KEY (directory, name)
+        );
+        """)
+        self.conn.commit()
+
+        for path, parent, mtime_ns, size, entries, watermark_ns in self.conn.execute("SELECT * FROM directories"):
+            self.directories[path] = DirectoryState(mtime_ns, size, entries, watermark_ns)
+        for path, parent, *_ in self.conn.execute("SELECT * FROM directories WHERE parent IS NOT NULL"):
+            if parent in self.directories:
+                self.directories[parent].children.add(path)
+        for directory, name, ctime_ns in self.conn.execute("SELECT * FROM emitted_files"):
+            if directory in self.directories:
+                self.directories[directory].emitted[name] = ctime_ns
+
+        logger.info(f"Polling {self.source_dir} every {self.interval} seconds, {len(self.directories)} directories in {self.snapshot_path}")
+
+    def poll(self):
+        start_time = time.monotonic()
+        # An empty snapshot only records the tree, existing files are not emitted
+        baseline = not self.directories
+        dirty = set()
+        removed = set()
+        emitted_count = self.emit_settled_files(dirty)
+
+        stat_count = 0
+        stack = [self.source_dir]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                logger.debug(f"Error polling {path}: {e}")
+                continue
+            stat_count += 1
+
+            state = self.directories.get(path)
+            if state is None:
+                state = self.directories[path] = DirectoryState()
+
+            if (st.st_mtime_ns, st.st_size) != (state.mtime_ns, state.size):
+                self.scan_directory(path, state, st, baseline, removed)
+                dirty.add(path)
+
+            stack.extend(state.children)
+
+        self.save_snapshot(dirty, removed)
+        logger.debug(f"Polled {stat_count} directories in {time.monotonic() - start_time:.3f} seconds, "
+                     f"{len(dirty)} changed, {emitted_count} files emitted, {len(self.pending_files)} pending")
+
+    def scan_directory(self, path, state, st, baseline, removed):
+        children = set()
+        entries = 0
+        with os.scandir(path) as directory_entries:
+            for entry in directory_entries:
+                entries += 1
+                if entry.is_dir(follow_symlinks=False):
+                    children.add(entry.path)
+                    continue
+                if entry.path in self.pending_files or not self.is_tile_file(entry.name):
+                    continue
+
+                file_stat = entry.stat(follow_symlinks=False)
+                # ctime and not mtime: files moved or copied with their original mtime are still new
+                ctime_ns = file_stat.st_ctime_ns
+                if ctime_ns < state.watermark_ns or state.emitted.get(entry.name) == ctime_ns:
+                    continue
+
+                if baseline:
+                    state.emitted[entry.name] = ctime_ns
+                else:
+                    self.pending_files[entry.path] = (path, file_stat.st_size, ctime_ns)
+
+        for child in state.children - children:
+            self.forget_directory(child, removed)
+
+        state.children = children
+        state.entries = entries
+        state.size = st.st_size
+        # A racy mtime is not recorded so the directory is listed again on the next poll
+        state.mtime_ns = 0 if time.time_ns() - st.st_mtime_ns < RACY_SECONDS * 1e9 else st.st_mtime_ns
+        if baseline:
+            self.update_watermark(path, state)
+
+    def emit_settled_files(self, dirty):
+        """Emits the pending files whose size and ctime did not change since the previous poll"""
+        emitted_count = 0
+        for file_path, (directory, size, ctime_ns) in list(self.pending_files.items()):
+            state = self.directories.get(directory)
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                file_stat = None
+
+            if state is None or file_stat is None:
+                del self.pending_files[file_path]
+            elif (file_stat.st_size, file_stat.st_ctime_ns) == (size, ctime_ns):
+                del self.pending_files[file_path]
+                self.event_coalescer.file_finished(file_path, is_new_version=True)
+                state.emitted[os.path.basename(file_path)] = ctime_ns
+                dirty.add(directory)
+                emitted_count += 1
+            else:
+                self.pending_files[file_path] = (directory, file_stat.st_size, file_stat.st_ctime_ns)
+
+        for directory in dirty:
+            self.update_watermark(directory, self.directories[directory])
+
+        return emitted_count
+
+    def update_watermark(self, directory, state):
+        # Stay below the pending files, they are not persisted and must be found again after a restart
+        pending_ctimes = [ctime_ns for pending_directory, _, ctime_ns in self.pending_files.values() if pending_directory == directory]
+        watermark_ns = min(pending_ctimes) if pending_ctimes else max(state.emitted.values(), default=state.watermark_ns)
+        state.watermark_ns = max(state.watermark_ns, watermark_ns)
+        state.emitted = {name: ctime_ns for name, ctime_ns in state.emitted.items() if ctime_ns >= state.watermark_ns}
+
+    def forget_directory(self, path, removed):
+        state = self.directories.pop(path, None)
+        removed.add(path)
+        if state:
+            for child in state.children:
+                self.forget_directory(child, removed)
+
+    def save_snapshot(self, dirty, removed):
+        if not dirty and not removed:
+            return
+
+        dirty = [path for path in dirty if path in self.directories]
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany("DELETE FROM directories WHERE path = ?", [(path,) for path in removed])
+            self.conn.executemany("DELETE FROM emitted_files WHERE directory = ?", [(path,) for path in removed | set(dirty)])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO directories (path, parent, mtime_ns, size, entries, watermark_ns) VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, None if path == self.source_dir else os.path.dirname(path), state.mtime_ns, state.size, state.entries, state.watermark_ns)
+                 for path, state in ((path, self.directories[path]) for path in dirty)],
+            )
+            self.conn.executemany(
+                "INSERT INTO emitted_files (directory, name, ctime_ns) VALUES (?, ?, ?)",
+                [(path, name, ctime_ns) for path in dirty for name, ctime_ns in self.directories[path].emitted.items()],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def is_tile_file(self, filename):
+        return not patterns_match(filename, TEMP_FILES_PATTERNS) and patterns_match(filename, self.patterns)
@@ -0,0 +1,46 @@
+import cProfile, pstats, time, logging
+from tabulate import tabulate
+from src.Metrics import Metrics
+
+# Functions listed from the cProfile output, by cumulative time
+PROFILE_TOP_FUNCTIONS = 25
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+    """Prints where the time of a run went from the Metrics stage timers, and the cProfile stats with an output path"""
+
+    def __init__(self, metrics: Metrics, output_path=None):
+        self.metrics = metrics
+        self.output_path = output_path
+        self.profile = None
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        if self.output_path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        wall_seconds = time.perf_counter() - self.start_time
+
+        if self.profile:
+            self.profile.disable()
+            self.profile.dump_stats(self.output_path)
+            logger.info(f"cProfile stats written to {self.output_path}, top {PROFILE_TOP_FUNCTIONS} functions by cumulative time:")
+            pstats.Stats(self.profile).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+
+        self.print_stage_breakdown(wall_seconds)
+
+    def print_stage_breakdown(self, wall_seconds):
+        stages = sorted(self.metrics.stages.items(), key=lambda item: item[1].sum, reverse=True)
+        rows = [
+            [stage, histogram.count, f"{histogram.sum:.3f}",
+             f"{histogram.sum / histogram.count * 1000:.3f}" if histogram.count else "-",
+             f"{histogram.sum / wall_seconds * 100:.1f}"]
+            for stage, histogram in stages
+        ]
+        logger.info(f"Run took {wall_seconds:.3f} seconds, time per stage (stages of reader threads overlap the others):")
+        print(tabulate(rows, headers=["stage", "calls", "total_seconds", "mean_ms", "percent_of_run"], tablefmt="psql"))
@@ -0,0 +1,33 @@
+DEFAULT_PROFILE = "default"
+BULK_PROFILE = "bulk"
+SQLITE_PROFILES = [DEFAULT_PROFILE, BULK_PROFILE]
+
+# Recorded in the metadata table so a run can be reproduced
+SQLITE_PROFILE_KEY = "sqlite_profile"
+SQLITE_PRAGMAS_KEY = "sqlite_pragmas"
+
+# Terrain tiles are mostly 10-100 KB, large pages keep each blob in few overflow pages.
+# page_size is a property of the file and must be set before it switches to WAL.
+BULK_PAGE_SIZE = 65536
+
+# GDAL's own SQLite page cache (OGR_SQLITE_CACHE), in MB
+BULK_OGR_SQLITE_CACHE = 1024
+
+# Per-connection settings while ingesting. In WAL mode synchronous=NORMAL skips the fsync on
+# every commit and only syncs on checkpoints, without risking corruption.
+BULK_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": "-1048576",  # 1 GiB
+    "mmap_size": "1073741824",  # 1 GiB
+    "temp_store": "MEMORY",
+    "wal_autocheckpoint": "10000",
+}
+
+# Restored once the ingest is done
+SAFE_PRAGMAS = {
+    "synchronous": "FULL",
+    "wal_autocheckpoint": "1000",
+}
+
+def get_profile_pragmas(profile):
+    return dict(BULK_PRAGMAS) if profile == BULK_PROFILE else {}
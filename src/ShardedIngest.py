@@ -0,0 +1,46 @@
+import os, logging
+from src.TileDiscovery import TileDiscovery
+
+logger = logging.getLogger(__name__)
+
+SHARD_FILE_SUFFIXES = ["", "-wal", "-shm", ".history.sqlite", ".history.sqlite-wal", ".history.sqlite-shm"]
+
+def get_shard_path(gpkg_path, shard_index):
+    gpkg_name, gpkg_ext = os.path.splitext(gpkg_path)
+    return f"{gpkg_name}.shard{shard_index}{gpkg_ext}"
+
+def remove_shard_files(shard_path):
+    for suffix in SHARD_FILE_SUFFIXES:
+        if os.path.exists(f"{shard_path}{suffix}"):
+            os.remove(f"{shard_path}{suffix}")
+
+def find_tile_directories(source_dir, watch_patterns, discovery_workers):
+    """([(relative directory, "zoom/column")], [paths of the files outside of tile directories, e.g. layer.json])"""
+    tile_directories = []
+    loose_files = []
+
+    # Tile directories are listed by the shard workers, the coordinator only needs the layout
+    discovery = TileDiscovery(source_dir, watch_patterns, discovery_workers, list_tile_files=False)
+    for root, zoom_level, tile_column, files in discovery:
+        if zoom_level is not None:
+            tile_directories.append((os.path.relpath(root, source_dir), f"{zoom_level}/{tile_column}"))
+        else:
+            loose_files.extend(os.path.join(root, filename) for filename, _ in files)
+
+    # Discovery order depends on thread scheduling, sort so shards are reproducible
+    tile_directories.sort()
+
+    return tile_directories, loose_files
+
+def split_directories(directories, shards):
+    # Interleave so every shard gets a mix of zoom levels and similar amounts of work
+    return [directories[i::shards] for i in range(shards)]
+
+def ingest_shard(source_dir, shard_path, watch_patterns, directories, ingest_options):
+    """Process pool entry point, ingests the given tile directories into their own shard GeoPackage."""
+    from src.TilesToGpkg import TilesToGpkg
+
+    logger.info(f"Ingesting {len(directories)} directories into {shard_path}")
+    shard = TilesToGpkg(source_dir, shard_path, False, watch_patterns, directories=directories, **ingest_options)
+
+    return shard.gpkg_path
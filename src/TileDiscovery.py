@@ -0,0 +1,92 @@
+import os, threading, logging
+import concurrent.futures
+from queue import Queue, Full
+from src.utils import patterns_match
+
+DEFAULT_DISCOVERY_WORKERS = 4
+DEFAULT_DISCOVERY_QUEUE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+def parse_tile_row(filename):
+    tile_row = filename.split(".", 1)[0]
+    return int(tile_row) if tile_row.isdigit() else None
+
+class TileDiscovery:
+    """Yields (root, zoom_level, tile_column, [(filename, tile_row)]) for every directory of a tree, scanned on a thread pool"""
+
+    def __init__(self, source_dir, patterns, workers: int = DEFAULT_DISCOVERY_WORKERS,
+                 queue_size: int = DEFAULT_DISCOVERY_QUEUE_SIZE, list_tile_files: bool = True):
+        self.source_dir = source_dir
+        self.patterns = patterns
+        self.workers = max(workers, 1)
+        # False reports the tile directories without listing their files, when only the layout is needed
+        self.list_tile_files = list_tile_files
+        self.results = Queue(queue_size)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.closed = False
+
+    def __iter__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tile-discovery")
+        self.pending = 1
+        self.closed = False
+        parent_name, name = ([""] + os.path.normpath(self.source_dir).split(os.path.sep))[-2:]
+        self.executor.submit(self.scan, self.source_dir, parent_name, name)
+
+        try:
+            while True:
+                result = self.results.get()
+                if result is None:
+                    break
+                yield result
+        finally:
+            # Unblock the scanners if the consumer stopped early
+            self.closed = True
+            self.executor.shutdown(wait=False)
+
+    def put(self, result):
+        while not self.closed:
+            try:
+                self.results.put(result, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def scan(self, path, parent_name, name):
+        try:
+            if self.closed:
+                return
+
+            is_tiles_directory = parent_name.isdigit() and name.isdigit()
+            zoom_level, tile_column = (int(parent_name), int(name)) if is_tiles_directory else (None, None)
+
+            if is_tiles_directory and not self.list_tile_files:
+                self.put((path, zoom_level, tile_column, []))
+                return
+
+            files = []
+            subdirectories = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry)
+                    elif patterns_match(entry.name, self.patterns):
+                        files.append((entry.name, parse_tile_row(entry.name) if is_tiles_directory else None))
+
+            for entry in subdirectories:
+                with self.lock:
+                    self.pending += 1
+                self.executor.submit(self.scan, entry.path, name, entry.name)
+
+            self.put((path, zoom_level, tile_column, files))
+        except OSError as e:
+            # Same as os.walk, unreadable directories are skipped
+            logger.warning(f"Error scanning {path}: {e}")
+        finally:
+            with self.lock:
+                self.pending -= 1
+                done = self.pending == 0
+            if done:
+                self.put(None)
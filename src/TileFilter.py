@@ -0,0 +1,97 @@
+import math
+from src.constants import CLUSTERED_LAYOUT
+from src.utils import get_tile_key, TILE_KEY_BITS
+from src.CompletenessCheck import merge_intervals, get_column_segments
+
+# Last column and row a clustered tile key can hold
+MAX_KEY_COORDINATE = (1 << TILE_KEY_BITS) - 1
+
+def parse_zoom_range(value):
+    """'12' or '10-14'"""
+    first_zoom, _, last_zoom = value.partition("-")
+    zoom_range = (int(first_zoom), int(last_zoom or first_zoom))
+    if zoom_range[0] < 0 or zoom_range[0] > zoom_range[1]:
+        raise ValueError(f"Invalid zoom range {value}")
+    return zoom_range
+
+def parse_tile_rectangle(value):
+    """'z/x0-x1/y0-y1', the format of the ranges reported by --check, single columns or rows are allowed ('z/x/y0-y1')"""
+    parts = value.split("/")
+    if len(parts) != 3:
+        raise ValueError(f"Invalid tile range {value}, expected z/x0-x1/y0-y1")
+
+    zoom_level = int(parts[0])
+    first_column, last_column = parse_zoom_range(parts[1])
+    first_row, last_row = parse_zoom_range(parts[2])
+    return zoom_level, first_column, last_column, first_row, last_row
+
+def get_geographic_tile_range(zoom_level, west, south, east, north):
+    """(first_column, last_column, first_row, last_row) of the tiles intersecting a lon/lat bbox in the Cesium geographic scheme"""
+    tile_degrees = 180 / (1 << zoom_level)
+    last_column = (2 << zoom_level) - 1
+    last_row = (1 << zoom_level) - 1
+
+    def clamp(value, last_value):
+        return min(max(value, 0), last_value)
+
+    # A bbox edge on a tile boundary doesn't select the tile beyond it
+    return (clamp(math.floor((west + 180) / tile_degrees), last_column),
+            clamp(math.ceil((east + 180) / tile_degrees) - 1, last_column),
+            clamp(math.floor((south + 90) / tile_degrees), last_row),
+            clamp(math.ceil((north + 90) / tile_degrees) - 1, last_row))
+
+class TileFilter:
+    """Selects the tiles of an extraction by zoom ranges, tile rectangles and a lon/lat bbox"""
+
+    def __init__(self, zoom_ranges=None, tile_rectangles=None, bbox=None):
+        self.zoom_ranges = merge_intervals(zoom_ranges) if zoom_ranges else None
+        self.tile_rectangles = tile_rectangles or []
+        # (west, south, east, north) in degrees
+        self.bbox = bbox
+
+    def is_zoom_selected(self, zoom_level):
+        return self.zoom_ranges is None or any(first_zoom <= zoom_level <= last_zoom for first_zoom, last_zoom in self.zoom_ranges)
+
+    def get_rectangles(self, max_zoom_level):
+        """{zoom_level: [rectangle]} of the spatial filters, in the availability format of layer.json"""
+        rectangles = {}
+        for zoom_level, first_column, last_column, first_row, last_row in self.tile_rectangles:
+            if self.is_zoom_selected(zoom_level):
+                rectangles.setdefault(zoom_level, []).append({"startX": first_column, "endX": min(last_column, (2 << zoom_level) - 1),
+                                                              "startY": first_row, "endY": min(last_row, (1 << zoom_level) - 1)})
+
+        if self.bbox:
+            zoom_ranges = self.zoom_ranges or [(0, max_zoom_level)]
+            for first_zoom, last_zoom in zoom_ranges:
+                for zoom_level in range(first_zoom, min(last_zoom, max_zoom_level) + 1):
+                    first_column, last_column, first_row, last_row = get_geographic_tile_range(zoom_level, *self.bbox)
+                    rectangles.setdefault(zoom_level, []).append({"startX": first_column, "endX": last_column,
+                                                                  "startY": first_row, "endY": last_row})
+
+        return rectangles
+
+    def get_where_clauses(self, tiles_layout, max_zoom_level):
+        """Disjoint conditions on the tiles table (aliased as t) covering the selection, in tile order"""
+        clustered = tiles_layout == CLUSTERED_LAYOUT
+        if not self.tile_rectangles and not self.bbox:
+            if clustered:
+                return [f"t.fid BETWEEN {get_tile_key(first_zoom, 0, 0)} AND {get_tile_key(last_zoom, MAX_KEY_COORDINATE, MAX_KEY_COORDINATE)}"
+                        for first_zoom, last_zoom in self.zoom_ranges]
+            return [f"t.zoom_level BETWEEN {first_zoom} AND {last_zoom}" for first_zoom, last_zoom in self.zoom_ranges]
+
+        where_clauses = []
+        rectangles = self.get_rectangles(max_zoom_level)
+        for zoom_level in sorted(rectangles):
+            # Overlapping rectangles are split in column segments of disjoint rows, so no tile is selected twice
+            for first_column, last_column, rows in get_column_segments(rectangles[zoom_level]):
+                for first_row, last_row in rows:
+                    if clustered:
+                        # One contiguous fid range, the rows of the columns outside first_row-last_row are skipped
+                        where_clauses.append(f"t.fid BETWEEN {get_tile_key(zoom_level, first_column, first_row)} "
+                                             f"AND {get_tile_key(zoom_level, last_column, last_row)} "
+                                             f"AND t.tile_row BETWEEN {first_row} AND {last_row}")
+                    else:
+                        where_clauses.append(f"t.zoom_level = {zoom_level} AND t.tile_column BETWEEN {first_column} AND {last_column} "
+                                             f"AND t.tile_row BETWEEN {first_row} AND {last_row}")
+
+        return where_clauses
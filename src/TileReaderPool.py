@@ -0,0 +1,78 @@
+import threading, logging
+from queue import Queue, Full
+
+DEFAULT_READ_WORKERS = 0
+DEFAULT_READ_QUEUE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+class TileReaderPool:
+    """Reads tile files on a pool of threads while the caller thread stays the only one writing them"""
+
+    def __init__(self, read_tile, write_tile, workers: int, queue_size: int = DEFAULT_READ_QUEUE_SIZE):
+        self.read_tile = read_tile
+        self.write_tile = write_tile
+        self.workers = workers
+        self.paths_queue = Queue(queue_size)
+        self.tiles_queue = Queue(queue_size)
+        self.finished_workers = 0
+        self.threads = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self.read_loop, name=f"tile-reader-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def read_loop(self):
+        while True:
+            tile_path = self.paths_queue.get()
+            if tile_path is None:
+                self.tiles_queue.put(None)
+                return
+
+            try:
+                self.tiles_queue.put((self.read_tile(tile_path), None))
+            except Exception as e:
+                self.tiles_queue.put((tile_path, e))
+
+    def submit(self, tile_path):
+        while True:
+            try:
+                self.paths_queue.put_nowait(tile_path)
+                break
+            except Full:
+                # Readers are ahead of the writer, write one tile before retrying
+                self.write_next(block=True)
+
+        self.drain()
+
+    def drain(self):
+        while self.write_next(block=False):
+            pass
+
+    def write_next(self, block):
+        if self.tiles_queue.empty() and not block:
+            return False
+
+        item = self.tiles_queue.get()
+        if item is None:
+            self.finished_workers += 1
+            return True
+
+        tile, error = item
+        if error is not None:
+            logger.error(f"Error reading {tile}: {error}")
+            raise error
+
+        self.write_tile(tile)
+        return True
+
+    def join(self):
+        for _ in self.threads:
+            self.submit(None)
+
+        while self.finished_workers < self.workers:
+            self.write_next(block=True)
+
+        for thread in self.threads:
+            thread.join()
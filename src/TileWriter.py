@@ -0,0 +1,247 @@
+import sqlite3, logging
+from osgeo import gdal, ogr
+from src.constants import TERRAIN_TILES_TABLE, LAYER_JSON_TABLE, METADATA_TABLE, TILE_BLOBS_TABLE, ROWID_LAYOUT, CLUSTERED_LAYOUT
+from src.utils import get_tile_key
+from src.Metrics import Metrics
+
+OGR_WRITER = "ogr"
+SQLITE_WRITER = "sqlite"
+WRITERS = [OGR_WRITER, SQLITE_WRITER]
+
+# Rows buffered by the sqlite writer before they are sent with one executemany call
+MAX_PENDING_ROWS = 1000
+
+# GDAL 3.8+ bindings can set a binary field straight from bytes, older ones only take a hex string
+HAS_SET_FIELD_BINARY = hasattr(ogr.Feature, "SetFieldBinary")
+
+logger = logging.getLogger(__name__)
+
+def set_field_binary(feature, field_name, data):
+    if HAS_SET_FIELD_BINARY:
+        feature.SetFieldBinary(field_name, data)
+    else:
+        feature.SetFieldBinaryFromHexString(field_name, data.hex())
+
+class OGRTileWriter:
+    """Writes tiles through the OGR layers of the GeoPackage dataset."""
+
+    def __init__(self, ds, layout=ROWID_LAYOUT, dedupe=False, metrics: Metrics = None):
+        self.ds = ds
+        self.metrics = metrics or Metrics()
+        self.layout = layout
+        self.dedupe = dedupe
+        self.tiles_table = ds.GetLayerByName(TERRAIN_TILES_TABLE)
+        self.layer_json_table = ds.GetLayerByName(LAYER_JSON_TABLE)
+        self.metadata_table = ds.GetLayerByName(METADATA_TABLE)
+        self.blobs_table = ds.GetLayerByName(TILE_BLOBS_TABLE) if dedupe else None
+        if HAS_SET_FIELD_BINARY:
+            logger.info(f"GDAL {gdal.__version__}: tile_data is written from raw bytes")
+        else:
+            logger.warning(f"GDAL {gdal.__version__} has no Feature.SetFieldBinary (GDAL 3.8+), tile_data is written through a hex string")
+
+    def insert_tile(self, zoom_level, tile_column, tile_row, tile_data=None, blob_id=None):
+        feature = ogr.Feature(self.tiles_table.GetLayerDefn())
+        feature.SetField("zoom_level", zoom_level)
+        feature.SetField("tile_column", tile_column)
+        feature.SetField("tile_row", tile_row)
+        if blob_id is not None:
+            feature.SetField("blob_id", blob_id)
+        else:
+            with self.metrics.time("encode"):
+                set_field_binary(feature, "tile_data", tile_data)
+
+        with self.metrics.time("create_feature"):
+            if self.layout == CLUSTERED_LAYOUT:
+                feature.SetFID(get_tile_key(zoom_level, tile_column, tile_row))
+                # The key already exists when a tile is ingested again, replace it. GDAL would log the expected
+                # UNIQUE constraint failure of every replaced tile
+                gdal.PushErrorHandler('CPLQuietErrorHandler')
+                try:
+                    created = self.tiles_table.CreateFeature(feature) == ogr.OGRERR_NONE
+                finally:
+                    gdal.PopErrorHandler()
+                if not created:
+                    self.tiles_table.SetFeature(feature)
+            else:
+                self.tiles_table.CreateFeature(feature)
+
+        feature = None
+
+    def insert_blob(self, blob_hash, tile_data):
+        feature = ogr.Feature(self.blobs_table.GetLayerDefn())
+        feature.SetField("hash", blob_hash)
+        set_field_binary(feature, "tile_data", tile_data)
+        self.blobs_table.CreateFeature(feature)
+
+        return feature.GetFID()
+
+    def find_blob(self, blob_hash):
+        result = self.ds.ExecuteSQL(f"SELECT fid FROM {TILE_BLOBS_TABLE} WHERE hash = '{blob_hash}'")
+        try:
+            feature = result.GetNextFeature()
+            return feature.GetFID() if feature else None
+        finally:
+            self.ds.ReleaseResultSet(result)
+
+    def insert_layer_json(self, layer_json_data):
+        feature = ogr.Feature(self.layer_json_table.GetLayerDefn())
+        feature.SetField("data", layer_json_data)
+        self.layer_json_table.CreateFeature(feature)
+
+    def insert_metadata(self, key, value):
+        feature = ogr.Feature(self.metadata_table.GetLayerDefn())
+        feature.SetField("key", key)
+        feature.SetField("value", value)
+        self.metadata_table.CreateFeature(feature)
+
+    def begin(self):
+        self.ds.StartTransaction()
+
+    def commit(self):
+        self.ds.CommitTransaction()
+
+    def execute_sql(self, sql_statement):
+        result = self.ds.ExecuteSQL(sql_statement)
+        if result is not None:
+            self.ds.ReleaseResultSet(result)
+
+    def close(self):
+        self.tiles_table = None
+        self.layer_json_table = None
+        self.metadata_table = None
+        self.blobs_table = None
+        self.ds = None
+
+class SQLiteTileWriter:
+    """Appends tiles with sqlite3 to a GeoPackage whose tables were created with OGR"""
+
+    def __init__(self, gpkg_path, layout=ROWID_LAYOUT, dedupe=False, metrics: Metrics = None):
+        self.gpkg_path = gpkg_path
+        self.metrics = metrics or Metrics()
+        self.layout = layout
+        self.dedupe = dedupe
+        self.conn = sqlite3.connect(gpkg_path, isolation_level=None)
+        self.in_transaction = False
+        self.pending_tiles = []
+
+        columns = ["zoom_level", "tile_column", "tile_row", "tile_data"]
+        if dedupe:
+            columns.append("blob_id")
+        if layout == CLUSTERED_LAYOUT:
+            columns.insert(0, "fid")
+        insert_verb = "INSERT OR REPLACE" if layout == CLUSTERED_LAYOUT else "INSERT"
+        self.insert_tile_query = f"{insert_verb} INTO {TERRAIN_TILES_TABLE} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        self.insert_layer_json_query = f"INSERT INTO {LAYER_JSON_TABLE} (data) VALUES (?)"
+
+    def insert_tile(self, zoom_level, tile_column, tile_row, tile_data=None, blob_id=None):
+        row = (zoom_level, tile_column, tile_row, tile_data)
+        if self.dedupe:
+            row += (blob_id,)
+        if self.layout == CLUSTERED_LAYOUT:
+            row = (get_tile_key(zoom_level, tile_column, tile_row),) + row
+        self.pending_tiles.append(row)
+
+        if not self.in_transaction or len(self.pending_tiles) >= MAX_PENDING_ROWS:
+            self.flush()
+
+    def insert_blob(self, blob_hash, tile_data):
+        return self.conn.execute(f"INSERT INTO {TILE_BLOBS_TABLE} (hash, tile_data) VALUES (?, ?)", (blob_hash, tile_data)).lastrowid
+
+    def find_blob(self, blob_hash):
+        result = self.conn.execute(f"SELECT fid FROM {TILE_BLOBS_TABLE} WHERE hash = ?", (blob_hash,)).fetchone()
+        return result[0] if result else None
+
+    def insert_layer_json(self, layer_json_data):
+        self.conn.execute(self.insert_layer_json_query, (layer_json_data,))
+
+    def insert_metadata(self, key, value):
+        self.conn.execute(f"INSERT INTO {METADATA_TABLE} (key, value) VALUES (?, ?)", (key, value))
+
+    def flush(self):
+        if self.pending_tiles:
+            with self.metrics.time("executemany"):
+                self.conn.executemany(self.insert_tile_query, self.pending_tiles)
+            self.pending_tiles = []
+
+    def begin(self):
+        self.conn.execute("BEGIN")
+        self.in_transaction = True
+
+    def commit(self):
+        self.flush()
+        self.conn.execute("COMMIT")
+        self.in_transaction = False
+
+    def execute_sql(self, sql_statement):
+        self.flush()
+        self.conn.execute(sql_statement)
+
+    def merge_gpkg(self, source_gpkg_path):
+        """Appends the tiles and layer.json rows of another GeoPackage created by this CLI"""
+        self.flush()
+        self.conn.execute("ATTACH DATABASE ? AS source", (source_gpkg_path,))
+
+        try:
+            self.conn.execute("BEGIN")
+            # Both sides share the layout; clustered fids are tile keys and are kept
+            insert_verb = "INSERT OR REPLACE" if self.layout == CLUSTERED_LAYOUT else "INSERT"
+            fid_column = "fid, " if self.layout == CLUSTERED_LAYOUT else ""
+
+            if self.dedupe:
+                # Blob ids are local to each file, add the missing blobs and remap the references by hash
+                self.conn.execute(
+                    f"INSERT INTO main.{TILE_BLOBS_TABLE} (hash, tile_data) "
+                    f"SELECT s.hash, s.tile_data FROM source.{TILE_BLOBS_TABLE} s "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM main.{TILE_BLOBS_TABLE} m WHERE m.hash = s.hash) ORDER BY s.fid"
+                )
+                self.conn.execute(
+                    f"{insert_verb} INTO main.{TERRAIN_TILES_TABLE} ({fid_column}zoom_level, tile_column, tile_row, blob_id) "
+                    f"SELECT {'t.fid, ' if fid_column else ''}t.zoom_level, t.tile_column, t.tile_row, m.fid FROM source.{TERRAIN_TILES_TABLE} t "
+                    f"JOIN source.{TILE_BLOBS_TABLE} s ON s.fid = t.blob_id JOIN main.{TILE_BLOBS_TABLE} m ON m.hash = s.hash ORDER BY t.fid"
+                )
+            else:
+                self.conn.execute(
+                    f"{insert_verb} INTO main.{TERRAIN_TILES_TABLE} ({fid_column}zoom_level, tile_column, tile_row, tile_data) "
+                    f"SELECT {fid_column}zoom_level, tile_column, tile_row, tile_data FROM source.{TERRAIN_TILES_TABLE} ORDER BY fid"
+                )
+            self.conn.execute(f"INSERT INTO main.{LAYER_JSON_TABLE} (data) SELECT data FROM source.{LAYER_JSON_TABLE} ORDER BY fid")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.conn.execute("DETACH DATABASE source")
+
+    def update_contents(self):
+        # Keep gpkg_contents / gpkg_ogr_contents in sync with the rows inserted behind OGR's back
+        table_names = [TERRAIN_TILES_TABLE, LAYER_JSON_TABLE, METADATA_TABLE]
+        if self.dedupe:
+            table_names.append(TILE_BLOBS_TABLE)
+
+        for table_name in table_names:
+            self.conn.execute(
+                "UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE lower(table_name) = lower(?)",
+                (table_name,),
+            )
+            has_ogr_contents = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gpkg_ogr_contents'"
+            ).fetchone()
+            if has_ogr_contents:
+                self.conn.execute(
+                    f"UPDATE gpkg_ogr_contents SET feature_count = (SELECT COUNT(*) FROM {table_name}) WHERE lower(table_name) = lower(?)",
+                    (table_name,),
+                )
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        if self.in_transaction:
+            self.commit()
+        else:
+            self.flush()
+
+        self.update_contents()
+        self.conn.close()
+        self.conn = None
+        logger.debug(f"Closed sqlite writer for {self.gpkg_path}")
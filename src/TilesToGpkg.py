@@ -1,24 +1,142 @@
-import time, os, logging, signal
+import time, os, logging, signal, json, threading
+import concurrent.futures
 from queue import Queue, Empty
+from collections import OrderedDict
 import watchdog.events
 import watchdog.observers
 import watchdog
 from osgeo import gdal, ogr
-from src.utils import patterns_match
-from src.constants import TERRAIN_TILES_TABLE, LAYER_JSON_TABLE
+from src.utils import patterns_match, get_tile_hash
+from src.constants import (TERRAIN_TILES_TABLE, LAYER_JSON_TABLE, METADATA_TABLE, TILES_LAYOUT_KEY, ROWID_LAYOUT,
+                           TILE_BLOBS_TABLE, DEDUPE_KEY, EVENTS_WATCH_BACKEND, POLLING_WATCH_BACKEND)
 from src.FileHandler import Handler
-from src.HistoryDB import HistoryDatabase
+from src.EventCoalescer import EventCoalescer
+from src.PollingWatcher import PollingWatcher, DEFAULT_POLL_INTERVAL
+from src.ArchiveSource import is_archive_source, iterate_archive_files, STDIN_SOURCE
+from src.Metrics import Metrics
+from src.HistoryDB import HistoryDatabase, get_directory_key, HISTORY_CTIME_MARGIN_SECONDS
+from src.TileWriter import OGRTileWriter, SQLiteTileWriter, OGR_WRITER, SQLITE_WRITER
+from src.TileReaderPool import TileReaderPool, DEFAULT_READ_WORKERS, DEFAULT_READ_QUEUE_SIZE
+from src.TileDiscovery import TileDiscovery, parse_tile_row, DEFAULT_DISCOVERY_WORKERS
+from src.SQLiteProfile import (get_profile_pragmas, DEFAULT_PROFILE, BULK_PROFILE, BULK_PAGE_SIZE, BULK_OGR_SQLITE_CACHE,
+                               SAFE_PRAGMAS, SQLITE_PROFILE_KEY, SQLITE_PRAGMAS_KEY)
+from src.ShardedIngest import find_tile_directories, split_directories, get_shard_path, remove_shard_files, ingest_shard
 
 logger = logging.getLogger(__name__)
 
+# Hash -> blob id of recently stored blobs, misses fall back to the unique index on tile_blobs.hash
+BLOB_CACHE_SIZE = 100000
+
+# Batching is disabled by default (every insert is committed on its own)
+DEFAULT_BATCH_SIZE = 0
+DEFAULT_BATCH_INTERVAL = 0
+
+# Watch mode drains up to DEFAULT_WATCH_BATCH_SIZE events, waiting at most DEFAULT_WATCH_BATCH_WAIT seconds
+# for the batch to fill, and inserts them in one transaction
+DEFAULT_WATCH_BATCH_SIZE = 1000
+DEFAULT_WATCH_BATCH_WAIT = 0.5
+
+# How often the watch queue depth and lag are logged, in seconds
+WATCH_STATS_INTERVAL = 60
+
+# Longest a watch transaction stays open when --batch_size is used without --batch_interval, so readers see new tiles
+WATCH_COMMIT_INTERVAL = 5
+
+# Watch mode checkpoints the WAL into the GeoPackage every DEFAULT_CHECKPOINT_INTERVAL seconds
+DEFAULT_CHECKPOINT_INTERVAL = 300
+
+# The scheduled checkpoints are PASSIVE and never wait for readers, a WAL grown past this size is truncated, which waits for them
+WAL_TRUNCATE_SIZE = 256 * 1024 * 1024
+
+# Archives are inserted in transactions of ARCHIVE_BATCH_SIZE tiles unless --batch_size / --batch_interval are set
+ARCHIVE_BATCH_SIZE = 1000
+
+# Files modified this long before the catch-up started may still have buffered events (clock skew of network mounts)
+CATCH_UP_MARGIN_SECONDS = 2
+
 class TilesToGpkg:
-    def __init__(self, source_dir: str, gpkg_path: str, is_watch_mode: bool, watch_patterns: list) -> None:
+    def __init__(self, source_dir: str, gpkg_path: str, is_watch_mode: bool, watch_patterns: list,
+                 batch_size: int = DEFAULT_BATCH_SIZE, batch_interval: float = DEFAULT_BATCH_INTERVAL,
+                 writer: str = OGR_WRITER, read_workers: int = DEFAULT_READ_WORKERS,
+                 read_queue_size: int = DEFAULT_READ_QUEUE_SIZE, shards: int = 0, directories: list = None,
+                 discovery_workers: int = DEFAULT_DISCOVERY_WORKERS, layout: str = ROWID_LAYOUT,
+                 sqlite_profile: str = DEFAULT_PROFILE, dedupe: bool = False,
+                 watch_batch_size: int = DEFAULT_WATCH_BATCH_SIZE, watch_batch_wait: float = DEFAULT_WATCH_BATCH_WAIT,
+                 watch_backend: str = EVENTS_WATCH_BACKEND, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 catch_up: bool = False, checkpoint_interval: float = DEFAULT_CHECKPOINT_INTERVAL,
+                 metrics: Metrics = None) -> None:
         self.source_dir = source_dir
         self.is_watch_mode = is_watch_mode
         self.watch_patterns = watch_patterns
         self.gpkg_path = gpkg_path
         self.event_queue = Queue()
-        self.history_db = HistoryDatabase(f"{gpkg_path}.history.sqlite")
+        # Shard workers count into their own Metrics, only the coordinator's are reported
+        self.metrics = metrics or Metrics()
+        self.event_coalescer = EventCoalescer(self.event_queue)
+        self.read_workers = read_workers
+        self.read_queue_size = read_queue_size
+        self.discovery_workers = discovery_workers
+        self.shards = shards
+        self.layout = layout
+        self.sqlite_profile = sqlite_profile
+        self.dedupe = dedupe
+        self.blob_cache = OrderedDict()
+        # Relative tile directories to ingest instead of walking the whole source (used by shard workers)
+        self.directories = directories
+        # Options forwarded to shard workers
+        self.ingest_options = {
+            "batch_size": batch_size,
+            "batch_interval": batch_interval,
+            "writer": writer,
+            "read_workers": read_workers,
+            "read_queue_size": read_queue_size,
+            "discovery_workers": discovery_workers,
+            "layout": layout,
+            "sqlite_profile": sqlite_profile,
+            "dedupe": dedupe,
+        }
+
+        # Batched ingest: group inserts into one transaction per batch_size tiles or batch_interval seconds
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.is_batch_mode = batch_size > 0 or batch_interval > 0
+        if is_watch_mode and self.is_batch_mode and batch_interval == 0:
+            self.batch_interval = WATCH_COMMIT_INTERVAL
+        if is_archive_source(source_dir) and not self.is_batch_mode:
+            self.batch_size = ARCHIVE_BATCH_SIZE
+            self.is_batch_mode = True
+        self.in_transaction = False
+        self.batch_count = 0
+        self.batch_started_at = 0
+
+        # Watch mode micro-batches, queue depth and lag (seconds between an event and its insert) are kept for monitoring
+        self.watch_batch_size = watch_batch_size
+        self.watch_batch_wait = watch_batch_wait
+        self.watch_queue_depth = 0
+        self.watch_lag = 0
+        self.watch_max_lag = 0
+        self.watch_events_count = 0
+        self.watch_stats_logged_at = time.monotonic()
+        if is_watch_mode:
+            self.metrics.add_gauge("event_queue", self.event_queue.qsize)
+            self.metrics.add_gauge("watch_lag_seconds", lambda: round(self.watch_lag, 3))
+        self.watch_backend = watch_backend
+        self.poll_interval = poll_interval
+        # Next to the history, so a restarted polling watcher finds it even if the output file gets renamed
+        self.snapshot_path = f"{gpkg_path}.snapshot.sqlite"
+        # Watch mode keeps the live GeoPackage readable: indexed up front and checkpointed on a schedule
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpointed_at = time.monotonic()
+        # Catch-up: path -> mtime of the tiles the initial scan read while they may have had buffered events
+        self.claimed_tiles = None
+        self.catch_up_started_ns = 0
+        self.is_catching_up = False
+        # Counts the tiles of a directory ingest ahead of it, see count_tiles
+        self.count_thread = None
+
+        # In batch and watch mode the history is flushed together with the GeoPackage commit
+        self.history_db = HistoryDatabase(f"{gpkg_path}.history.sqlite", auto_flush=not (self.is_batch_mode or is_watch_mode))
+        self.history_db.on_flush = lambda seconds: self.metrics.observe("history_flush", seconds)
 
         # Check if the GeoPackage file already exists
         if os.path.exists(gpkg_path):
@@ -41,6 +159,9 @@ class TilesToGpkg:
 
         gdal.AllRegister()
 
+        if sqlite_profile == BULK_PROFILE:
+            gdal.SetConfigOption("OGR_SQLITE_CACHE", str(BULK_OGR_SQLITE_CACHE))
+
         signal.signal(signal.SIGINT, self.handle_interrupt)
 
         driver = ogr.GetDriverByName("GPKG")
@@ -53,27 +174,70 @@ class TilesToGpkg:
         if ds is None:
             logger.error("Failed to create GeoPackage.")
             raise RuntimeError("Failed to create GeoPackage.")
-        
-        self.ds = ds
-        self.ds.ExecuteSQL("PRAGMA journal_mode = wal;")
+
+        if sqlite_profile == BULK_PROFILE:
+            # The GeoPackage is still empty, rebuilding it with the new page size is instant
+            ds.ExecuteSQL(f"PRAGMA page_size = {BULK_PAGE_SIZE};")
+            ds.ExecuteSQL("VACUUM;")
+
+        ds.ExecuteSQL("PRAGMA journal_mode = wal;")
 
         tiles_table = ds.CreateLayer(TERRAIN_TILES_TABLE, geom_type=ogr.wkbNone)
         layer_json_table = ds.CreateLayer(LAYER_JSON_TABLE, geom_type=ogr.wkbNone)
+        metadata_table = ds.CreateLayer(METADATA_TABLE, geom_type=ogr.wkbNone)
 
         layer_json_table.CreateField(ogr.FieldDefn("data", ogr.OFTString))
 
+        metadata_table.CreateField(ogr.FieldDefn("key", ogr.OFTString))
+        metadata_table.CreateField(ogr.FieldDefn("value", ogr.OFTString))
+
         tiles_table.CreateField(ogr.FieldDefn("zoom_level", ogr.OFTInteger))
         tiles_table.CreateField(ogr.FieldDefn("tile_column", ogr.OFTInteger))
         tiles_table.CreateField(ogr.FieldDefn("tile_row", ogr.OFTInteger))
         tiles_table.CreateField(ogr.FieldDefn("tile_data", ogr.OFTBinary))
 
-        self.tiles_table = tiles_table
-        self.layer_json_table = layer_json_table
+        if dedupe:
+            tiles_table.CreateField(ogr.FieldDefn("blob_id", ogr.OFTInteger64))
+
+            blobs_table = ds.CreateLayer(TILE_BLOBS_TABLE, geom_type=ogr.wkbNone)
+            blobs_table.CreateField(ogr.FieldDefn("hash", ogr.OFTString))
+            blobs_table.CreateField(ogr.FieldDefn("tile_data", ogr.OFTBinary))
+            blobs_table = None
+            ds.ExecuteSQL(f"CREATE UNIQUE INDEX tile_blobs_hash_idx ON {TILE_BLOBS_TABLE} (hash)")
+
+        if writer == SQLITE_WRITER:
+            # Close the OGR dataset so the GeoPackage metadata is written before sqlite3 takes over
+            tiles_table = layer_json_table = metadata_table = ds = None
+            self.writer = SQLiteTileWriter(self.gpkg_path, layout, dedupe, self.metrics)
+        else:
+            tiles_table = layer_json_table = metadata_table = None
+            self.writer = OGRTileWriter(ds, layout, dedupe, self.metrics)
+
+        self.apply_sqlite_profile()
+
+        self.writer.insert_metadata(TILES_LAYOUT_KEY, layout)
+        self.writer.insert_metadata(SQLITE_PROFILE_KEY, sqlite_profile)
+        self.writer.insert_metadata(DEDUPE_KEY, "true" if dedupe else "false")
+        if sqlite_profile == BULK_PROFILE:
+            profile_settings = {"page_size": BULK_PAGE_SIZE, "OGR_SQLITE_CACHE": BULK_OGR_SQLITE_CACHE, **get_profile_pragmas(sqlite_profile)}
+            self.writer.insert_metadata(SQLITE_PRAGMAS_KEY, json.dumps(profile_settings))
+
+        logger.info(f"Writing tiles to {self.gpkg_path} using the {writer} writer and the {layout} layout{' with deduplication' if dedupe else ''}")
+
+        if self.is_batch_mode:
+            logger.info(f"Batched ingest enabled (batch size: {batch_size or 'unlimited'}, interval: {self.batch_interval or 'unlimited'} seconds)")
 
         if is_watch_mode:
+            logger.info(f"Watch events are inserted in batches of up to {watch_batch_size} events or {watch_batch_wait} seconds")
             observer = self.watch_files_in_dir()
 
             try:
+                if catch_up:
+                    self.catch_up()
+
+                # Readers of the live file get indexed lookups, the index is maintained by every insert from now on
+                self.create_tiles_index()
+
                 while True:
                     self.process_events()
             except KeyboardInterrupt:
@@ -82,6 +246,12 @@ class TilesToGpkg:
                 observer.join()
                 time.sleep(2)
 
+        elif is_archive_source(source_dir):
+            self.iterate_files_in_archive()
+
+        elif shards > 1:
+            self.iterate_files_in_shards()
+
         else:
             self.iterate_files_in_dir()
     
@@ -91,31 +261,257 @@ class TilesToGpkg:
         raise SystemExit
 
     def iterate_files_in_dir(self):
+        self.ingest_existing_tiles()
+
+        self.finalize()
+
+    def iterate_files_in_archive(self):
+        logger.info(f"Reading {self.watch_patterns} files from {'stdin' if self.source_dir == STDIN_SOURCE else self.source_dir}.")
+        start_time = time.time()
+        tiles_count = 0
+        # The tiles of a directory can be spread over the archive, only skip the directories recorded by previous runs
+        started_directories = set()
+
+        for member_path, data in iterate_archive_files(self.source_dir, self.watch_patterns):
+            self.metrics.add_discovered()
+            tile = self.read_archive_member(member_path, data)
+            if tile is None:
+                continue
+
+            zoom_level, tile_column = tile[1], tile[2]
+            if zoom_level is not None:
+                directory = f"{zoom_level}/{tile_column}"
+                if directory not in started_directories:
+                    if self.history_db.has_directory(directory):
+                        logger.debug(f"Skipping {member_path}")
+                        continue
+                    started_directories.add(directory)
+
+            self.write_tile(tile)
+            tiles_count += 1
+
+        self.commit_batch()
+        logger.info(f"Inserted {tiles_count} files from the archive in {time.time() - start_time:.1f} seconds")
+
+        self.finalize()
+
+    def read_archive_member(self, member_path, data):
+        """Same as read_tile for a file already read from an archive, returns None for tiles outside of a z/x/y.terrain path"""
+        if "layer.json" in member_path:
+            return member_path, None, None, None, data.decode("utf-8"), None, None
+
+        path_components = member_path.split("/")
+        try:
+            zoom_level = int(path_components[-3])
+            tile_column = int(path_components[-2])
+            tile_row = int(path_components[-1].split(".", 1)[0])
+        except (ValueError, IndexError):
+            logger.warning(f"Skipping {member_path}, unable to extract zoom level, tile column, or tile row.")
+            return None
+
+        blob_hash = get_tile_hash(data) if self.dedupe else None
+
+        return member_path, zoom_level, tile_column, tile_row, data, blob_hash, None
+
+    def catch_up(self):
+        """Ingests the existing tiles while the watcher, started beforehand, buffers its events"""
+        logger.info("Catching up with the existing tiles, new events are buffered until it is done...")
+        start_time = time.time()
+        self.catch_up_started_ns = time.time_ns() - CATCH_UP_MARGIN_SECONDS * 10**9
+        self.claimed_tiles = {}
+
+        # Without batches nothing flushes the history in watch mode, let it flush on its own during the scan
+        self.history_db.auto_flush = not self.is_batch_mode
+        self.is_catching_up = True
+        try:
+            self.ingest_existing_tiles()
+        finally:
+            self.is_catching_up = False
+        self.history_db.auto_flush = False
+        self.history_db.flush()
+
+        logger.info(f"Caught up in {time.time() - start_time:.1f} seconds, replaying {self.event_queue.qsize()} buffered events "
+                    f"({len(self.claimed_tiles)} tiles were written during the catch-up)")
+
+    def claim_tile(self, tile_path, mtime_ns):
+        # Called from the reader threads, dict assignment is atomic
+        if mtime_ns >= self.catch_up_started_ns:
+            self.claimed_tiles[os.path.abspath(tile_path)] = mtime_ns
+
+    def is_claimed(self, tile_path):
+        """True when the catch-up scan already ingested this version of the file"""
+        mtime_ns = self.claimed_tiles.get(os.path.abspath(tile_path))
+        if mtime_ns is None:
+            return False
+        try:
+            return os.stat(tile_path).st_mtime_ns == mtime_ns
+        except OSError:
+            return False
+
+    def ingest_existing_tiles(self):
         logger.info(f'Iterating over {self.watch_patterns} files in {self.source_dir}.')
-        
-        for root, _, files in os.walk(self.source_dir):
-            root_components = os.path.normpath(root).split(os.path.sep)[-2:]
-            if all(component.isdigit() for component in root_components):
-                # Presumably tiles directory
-                zoom_level, tile_column = map(int, root_components)
-
-                if self.history_db.has_directory(f"{zoom_level}/{tile_column}"):
+
+        reader_pool = None
+        if self.read_workers > 0:
+            logger.info(f"Reading tiles with {self.read_workers} threads (queue size: {self.read_queue_size})")
+            reader_pool = TileReaderPool(lambda tile: self.read_tile(*tile), self.write_tile, self.read_workers, self.read_queue_size)
+            self.metrics.add_gauge("read_paths_queue", reader_pool.paths_queue.qsize)
+            self.metrics.add_gauge("read_tiles_queue", reader_pool.tiles_queue.qsize)
+
+        if self.directories is None and not self.is_catching_up:
+            # The discovery below only runs a few directories ahead of the readers, the total is known much earlier this way
+            self.count_thread = threading.Thread(target=self.count_tiles, args=(set(self.history_db.directories),),
+                                                 name="tile-counter", daemon=True)
+            self.count_thread.start()
+
+        tiles = self.find_tiles()
+        while True:
+            # Time spent waiting for the discovery
+            with self.metrics.time("discover"):
+                tile = next(tiles, None)
+            if tile is None:
+                break
+
+            if self.count_thread is None:
+                self.metrics.add_discovered()
+            if reader_pool:
+                reader_pool.submit(tile)
+            else:
+                self.write_tile(self.read_tile(*tile))
+
+        if self.count_thread is None:
+            self.metrics.discovery_done = True
+        if reader_pool:
+            reader_pool.join()
+
+        self.commit_batch()
+
+    def count_tiles(self, known_directories):
+        """Adds the tiles find_tiles will yield to the discovered count, known_directories are the history directories"""
+        discovery = TileDiscovery(self.source_dir, self.watch_patterns, self.discovery_workers)
+        for _, zoom_level, tile_column, files in discovery:
+            if zoom_level is None or get_directory_key(f"{zoom_level}/{tile_column}") not in known_directories:
+                self.metrics.add_discovered(len(files))
+        self.metrics.discovery_done = True
+
+    def find_tiles(self):
+        """Yields (tile_path, zoom_level, tile_column, tile_row) for every tile to ingest"""
+        if self.directories is not None:
+            for directory in self.directories:
+                root = os.path.join(self.source_dir, directory)
+                zoom_level, tile_column = map(int, os.path.normpath(root).split(os.path.sep)[-2:])
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        if patterns_match(entry.name, self.watch_patterns):
+                            yield entry.path, zoom_level, tile_column, parse_tile_row(entry.name)
+            return
+
+        discovery = TileDiscovery(self.source_dir, self.watch_patterns, self.discovery_workers)
+        self.metrics.add_gauge("discovery_queue", discovery.results.qsize)
+        for root, zoom_level, tile_column, files in discovery:
+            if zoom_level is not None and self.history_db.has_directory(f"{zoom_level}/{tile_column}"):
+                if self.is_catching_up:
+                    # Watch sessions record every directory they touch, only the changed files were missed
+                    yield from self.find_changed_tiles(root, zoom_level, tile_column, files)
+                else:
                     logger.debug(f"Skipping {root}")
+                continue
+
+            for filename, tile_row in files:
+                yield os.path.join(root, filename), zoom_level, tile_column, tile_row
+
+    def find_changed_tiles(self, root, zoom_level, tile_column, files):
+        """Tiles of a directory in the history changed after its watermark, or within the margin before it and not ingested"""
+        directory = f"{zoom_level}/{tile_column}"
+        watermark_ns = self.history_db.get_ctime_watermark(directory)
+        if watermark_ns is None:
+            logger.debug(f"Skipping {root}, recorded without a ctime watermark")
+            return
+
+        margin_start_ns = watermark_ns - HISTORY_CTIME_MARGIN_SECONDS * 10**9
+        boundary_tiles = None
+        for filename, tile_row in files:
+            tile_path = os.path.join(root, filename)
+            try:
+                ctime_ns = os.stat(tile_path).st_ctime_ns
+            except FileNotFoundError:
+                continue
+            if ctime_ns > watermark_ns:
+                yield tile_path, zoom_level, tile_column, tile_row
+            elif ctime_ns >= margin_start_ns:
+                if boundary_tiles is None:
+                    boundary_tiles = self.history_db.get_boundary_tiles(directory)
+                # Still queued when the previous session stopped
+                if boundary_tiles.get(tile_row) != ctime_ns:
+                    yield tile_path, zoom_level, tile_column, tile_row
+
+    def iterate_files_in_shards(self):
+        logger.info(f'Iterating over {self.watch_patterns} files in {self.source_dir} using {self.shards} shards.')
+        start_time = time.time()
+
+        tile_directories, loose_files = find_tile_directories(self.source_dir, self.watch_patterns, self.discovery_workers)
+        pending_directories = []
+        for relative_dir, directory in tile_directories:
+            if self.history_db.has_directory(directory):
+                logger.debug(f"Skipping {relative_dir}")
+            else:
+                pending_directories.append(relative_dir)
+
+        # Files outside of tile directories (layer.json) are written by the coordinator itself
+        for tile_path in loose_files:
+            self.process_tile(tile_path)
+        self.commit_batch()
+
+        # Shards are merged with SQL, switch to the sqlite writer for the rest of the run
+        self.writer.close()
+        self.writer = SQLiteTileWriter(self.gpkg_path, self.layout, self.dedupe, self.metrics)
+        self.apply_sqlite_profile()
+
+        shard_paths = [get_shard_path(self.gpkg_path, i) for i in range(self.shards)]
+        shard_directories = split_directories(pending_directories, self.shards)
+        failed_shards = 0
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.shards) as executor:
+            futures = {}
+            for shard_path, directories in zip(shard_paths, shard_directories):
+                if not directories:
+                    continue
+                # Leftovers of an interrupted run were never merged, their directories are ingested again
+                remove_shard_files(shard_path)
+                future = executor.submit(ingest_shard, self.source_dir, shard_path, self.watch_patterns, directories, self.ingest_options)
+                futures[future] = shard_path
+
+            for future in concurrent.futures.as_completed(futures):
+                shard_path = futures[future]
+                try:
+                    future.result()
+                except BaseException as e:
+                    failed_shards += 1
+                    logger.error(f"Shard {shard_path} failed, its directories will be ingested on the next run: {e}")
                     continue
 
-            for filename in files:
-                if patterns_match(filename, self.watch_patterns):
-                    tile_path = os.path.join(root, filename)
-                    self.process_tile(tile_path)
-        
-        logger.info('Indexing GeoPackage...')
-        self.ds.ExecuteSQL("CREATE INDEX tiles_idx ON terrain_tiles (zoom_level, tile_column, tile_row)")
-        self.history_db.close_connection()
+                logger.info(f"Merging {shard_path} into {self.gpkg_path}...")
+                with self.metrics.time("merge"):
+                    self.writer.merge_gpkg(shard_path)
+                self.history_db.merge_history(f"{shard_path}.history.sqlite")
+                remove_shard_files(shard_path)
+
+        logger.info(f"Shards ingested in {time.time() - start_time:.1f} seconds")
+
+        self.finalize()
+
+        if failed_shards:
+            raise RuntimeError(f"{failed_shards} of {self.shards} shards failed")
 
     def watch_files_in_dir(self):
         logger.info(f'Watching {self.source_dir} for {self.watch_patterns} files.')
 
-        event_handler = Handler(self.watch_patterns, self.event_queue)
+        if self.watch_backend == POLLING_WATCH_BACKEND:
+            observer = PollingWatcher(self.source_dir, self.watch_patterns, self.event_coalescer, self.snapshot_path, self.poll_interval)
+            observer.start()
+            return observer
+
+        event_handler = Handler(self.watch_patterns, self.event_coalescer)
         observer = watchdog.observers.Observer()
         observer.schedule(event_handler, path=self.source_dir, recursive=True)
         observer.start()
@@ -123,62 +519,238 @@ class TilesToGpkg:
         return observer
 
     def process_events(self):
+        # Files without a close event are only queued once they stopped changing
+        self.event_coalescer.emit_settled()
+        events = self.next_events()
+        if not events:
+            logger.debug("No events in the queue.")
+            # Don't keep an idle batch open longer than its time window
+            if self.is_batch_due():
+                self.commit_batch()
+            self.checkpoint_if_due()
+            self.log_watch_stats()
+            return
+
+        # The whole micro-batch is one transaction, unless --batch_size / --batch_interval already manage commits
+        if not self.in_transaction:
+            self.start_transaction()
+
+        for file_path, enqueued_at in events:
+            try:
+                if self.claimed_tiles and self.is_claimed(file_path):
+                    logger.debug(f"Skipping event of {file_path}, already ingested by the catch-up")
+                    continue
+                logger.debug(f"Processing event: {file_path}")
+                self.process_tile(file_path)
+            except Exception as e:
+                logger.error(f"Error processing events: {e}")
+                import traceback
+                traceback.print_exc()
+            finally:
+                self.event_queue.task_done()
+
+        if not self.is_batch_mode or self.is_batch_due():
+            self.commit_batch()
+
+        # Lag of the oldest event of the batch, measured once it is committed
+        self.watch_lag = time.monotonic() - events[0][1]
+        self.watch_max_lag = max(self.watch_max_lag, self.watch_lag)
+        self.watch_queue_depth = self.event_queue.qsize()
+        self.watch_events_count += len(events)
+        logger.debug(f"Inserted {len(events)} events, queue depth: {self.watch_queue_depth}, lag: {self.watch_lag:.3f} seconds")
+        self.checkpoint_if_due()
+        self.log_watch_stats()
+
+    def next_events(self):
+        """Waits up to a second for an event, then collects more until watch_batch_size events or watch_batch_wait seconds"""
         try:
-            file_path = self.event_queue.get(timeout=1)
-            logger.debug(f"Processing event: {file_path}")
-            self.process_tile(file_path)
-            self.event_queue.task_done()
+            events = [self.event_queue.get(timeout=1)]
         except Empty:
-            logger.debug("No events in the queue.")
-            pass
-        except Exception as e:
-            logger.error(f"Error processing events: {e}")
-            import traceback
-            traceback.print_exc()
+            return []
+
+        deadline = time.monotonic() + self.watch_batch_wait
+        while len(events) < self.watch_batch_size:
+            try:
+                events.append(self.event_queue.get_nowait())
+                continue
+            except Empty:
+                pass
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self.event_queue.get(timeout=remaining))
+            except Empty:
+                break
+
+        return events
+
+    def log_watch_stats(self):
+        if time.monotonic() - self.watch_stats_logged_at < WATCH_STATS_INTERVAL:
+            return
+
+        logger.info(f"Watch: {self.watch_events_count} events inserted, queue depth: {self.event_queue.qsize()}, "
+                    f"lag: {self.watch_lag:.3f} seconds (max {self.watch_max_lag:.3f}), "
+                    f"{self.event_coalescer.dropped_events} duplicated events dropped")
+        self.watch_events_count = 0
+        self.watch_max_lag = 0
+        self.watch_stats_logged_at = time.monotonic()
 
     def process_tile(self, tile_path):
         logger.debug(f"Processing {tile_path}")
+        self.write_tile(self.read_tile(tile_path))
 
+    def read_tile(self, tile_path, zoom_level=None, tile_column=None, tile_row=None):
+        """(tile_path, zoom_level, tile_column, tile_row, data, blob_hash, ctime_ns), the coordinates are None for layer.json"""
         if "layer.json" in tile_path:
             with open(tile_path, "r") as jsonFile:
                 layerJsonData = jsonFile.read()
-            
-            logger.debug(layerJsonData)
+                if self.claimed_tiles is not None:
+                    self.claim_tile(tile_path, os.fstat(jsonFile.fileno()).st_mtime_ns)
+
+            return tile_path, None, None, None, layerJsonData, None, None
+
+        if tile_row is None:
+            # Coordinates were not provided by the discovery, take them from the path
+            path_components = tile_path.split(os.path.sep)
+
+            try:
+                zoom_level = int(path_components[-3])
+                tile_column = int(path_components[-2])
+                tile_row = int(os.path.splitext(path_components[-1])[0])
+            except ValueError:
+                logger.error(f"Error processing tile: {tile_path}. Unable to extract zoom level, tile column, or tile row.")
+                raise RuntimeError(f"Error processing tile: {tile_path}. Unable to extract zoom level, tile column, or tile row.")
+
+        with self.metrics.time("read"), open(tile_path, "rb") as tile_file:
+            tile_data = tile_file.read()
+            tile_stat = os.fstat(tile_file.fileno())
+            if self.claimed_tiles is not None:
+                self.claim_tile(tile_path, tile_stat.st_mtime_ns)
+
+        # Hashed here so it runs on the reader threads
+        blob_hash = get_tile_hash(tile_data) if self.dedupe else None
+
+        return tile_path, zoom_level, tile_column, tile_row, tile_data, blob_hash, tile_stat.st_ctime_ns
+
+    def write_tile(self, tile):
+        _, zoom_level, tile_column, tile_row, data, blob_hash, ctime_ns = tile
+
+        self.begin_batch()
+
+        with self.metrics.time("insert"):
+            if zoom_level is None:
+                logger.debug(data)
+                self.writer.insert_layer_json(data)
+            elif self.dedupe:
+                self.writer.insert_tile(zoom_level, tile_column, tile_row, blob_id=self.get_blob_id(blob_hash, data))
+                self.history_db.update_history(f"{zoom_level}/{tile_column}", ctime_ns, tile_row)
+            else:
+                self.writer.insert_tile(zoom_level, tile_column, tile_row, data)
+                self.history_db.update_history(f"{zoom_level}/{tile_column}", ctime_ns, tile_row)
 
-            layerJsonFeature = ogr.Feature(self.layer_json_table.GetLayerDefn())
-            layerJsonFeature.SetField("data", layerJsonData)
-            self.layer_json_table.CreateFeature(layerJsonFeature)
+        self.metrics.add_tiles(0 if zoom_level is None else 1, len(data))
+        self.metrics.add_processed()
 
+        self.end_insert()
+
+    def get_blob_id(self, blob_hash, tile_data):
+        blob_id = self.blob_cache.get(blob_hash)
+        if blob_id is not None:
+            self.blob_cache.move_to_end(blob_hash)
+            return blob_id
+
+        blob_id = self.writer.find_blob(blob_hash)
+        if blob_id is None:
+            blob_id = self.writer.insert_blob(blob_hash, tile_data)
+
+        self.blob_cache[blob_hash] = blob_id
+        if len(self.blob_cache) > BLOB_CACHE_SIZE:
+            self.blob_cache.popitem(last=False)
+
+        return blob_id
+
+    def begin_batch(self):
+        if not self.is_batch_mode or self.in_transaction:
+            return
+
+        self.start_transaction()
+
+    def start_transaction(self):
+        self.writer.begin()
+        self.in_transaction = True
+        self.batch_count = 0
+        self.batch_started_at = time.monotonic()
+
+    def end_insert(self):
+        if not self.in_transaction:
             return
 
-        path_components = tile_path.split(os.path.sep)
+        self.batch_count += 1
+        if self.is_batch_due():
+            self.commit_batch()
+
+    def is_batch_due(self):
+        if not self.in_transaction:
+            return False
+        if self.batch_size > 0 and self.batch_count >= self.batch_size:
+            return True
+        if self.batch_interval > 0 and time.monotonic() - self.batch_started_at >= self.batch_interval:
+            return True
+        return False
+
+    def commit_batch(self):
+        if not self.in_transaction:
+            return
+
+        with self.metrics.time("commit"):
+            self.writer.commit()
+        self.in_transaction = False
+        # Flush the history only once the tiles it describes are committed
+        self.history_db.flush()
+        logger.debug(f"Committed batch of {self.batch_count} inserts in {time.monotonic() - self.batch_started_at:.3f} seconds")
+
+    def apply_sqlite_profile(self):
+        for pragma, value in get_profile_pragmas(self.sqlite_profile).items():
+            self.writer.execute_sql(f"PRAGMA {pragma} = {value};")
+
+    def create_tiles_index(self):
+        logger.info('Indexing GeoPackage...')
+        self.writer.execute_sql("CREATE INDEX IF NOT EXISTS tiles_idx ON terrain_tiles (zoom_level, tile_column, tile_row)")
+
+    def checkpoint_if_due(self):
+        """Copies the WAL into the GeoPackage between transactions, so it doesn't grow for the whole watch session"""
+        if self.in_transaction or self.checkpoint_interval <= 0 or time.monotonic() - self.checkpointed_at < self.checkpoint_interval:
+            return
 
         try:
-            zoom_level = int(path_components[-3])
-            tile_column = int(path_components[-2])
-            tile_row = int(os.path.splitext(path_components[-1])[0])
-        except ValueError:
-            logger.error(f"Error processing tile: {tile_path}. Unable to extract zoom level, tile column, or tile row.")
-            raise RuntimeError(f"Error processing tile: {tile_path}. Unable to extract zoom level, tile column, or tile row.")
-        
-        directory = f"{zoom_level}/{tile_column}"
+            wal_size = os.path.getsize(f"{self.gpkg_path}-wal")
+        except OSError:
+            wal_size = 0
+        mode = "TRUNCATE" if wal_size > WAL_TRUNCATE_SIZE else "PASSIVE"
 
-        with open(tile_path, "rb") as tile_file:
-            tile_data = tile_file.read()
+        start_time = time.monotonic()
+        # Readers still using older snapshots can make a PASSIVE checkpoint partial, it completes on a later run
+        self.writer.execute_sql(f"PRAGMA wal_checkpoint({mode});")
+        self.checkpointed_at = time.monotonic()
+        logger.debug(f"Checkpointed the WAL ({mode}, {wal_size} bytes) in {self.checkpointed_at - start_time:.3f} seconds")
+
+    def finalize(self):
+        self.create_tiles_index()
 
-        feature = ogr.Feature(self.tiles_table.GetLayerDefn())
-        feature.SetField("zoom_level", zoom_level)
-        feature.SetField("tile_column", tile_column)
-        feature.SetField("tile_row", tile_row)
-        feature.SetFieldBinaryFromHexString("tile_data", tile_data.hex())
-        self.tiles_table.CreateFeature(feature)
+        if self.sqlite_profile == BULK_PROFILE:
+            logger.info('Restoring safe SQLite settings and analyzing GeoPackage...')
+            for pragma, value in SAFE_PRAGMAS.items():
+                self.writer.execute_sql(f"PRAGMA {pragma} = {value};")
+            self.writer.execute_sql("ANALYZE;")
 
-        self.history_db.update_history(directory)
+        self.writer.execute_sql("PRAGMA wal_checkpoint(TRUNCATE);")
 
-        feature = None
+        self.writer.close()
+        self.history_db.close_connection()
 
     def stop_watcher(self):
-        logger.info('Indexing GeoPackage...')
-        self.ds.ExecuteSQL("CREATE INDEX tiles_idx ON terrain_tiles (zoom_level, tile_column, tile_row)")
-        self.ds = None
-        self.history_db.close_connection()
\ No newline at end of file
+        self.commit_batch()
+
+        self.finalize()
\ No newline at end of file
@@ -1,3 +1,19 @@
 TERRAIN_TILES_TABLE = "terrain_tiles"
 LAYER_JSON_TABLE = "layer_json"
-TEMP_FILES_PATTERNS = ["*.tmp"]
\ No newline at end of file
+TEMP_FILES_PATTERNS = ["*.tmp"]
+METADATA_TABLE = "ingest_metadata"
+
+# Storage layouts of the terrain_tiles table, recorded in the metadata table under TILES_LAYOUT_KEY
+TILES_LAYOUT_KEY = "tiles_layout"
+ROWID_LAYOUT = "rowid"
+CLUSTERED_LAYOUT = "clustered"
+TILES_LAYOUTS = [ROWID_LAYOUT, CLUSTERED_LAYOUT]
+
+# Content-addressed store of unique tile blobs, referenced by terrain_tiles.blob_id when deduplication is enabled
+TILE_BLOBS_TABLE = "tile_blobs"
+DEDUPE_KEY = "tiles_dedupe"
+
+# Watch mode backends: filesystem events (inotify and friends) or polling for network mounts
+EVENTS_WATCH_BACKEND = "events"
+POLLING_WATCH_BACKEND = "polling"
+WATCH_BACKENDS = [EVENTS_WATCH_BACKEND, POLLING_WATCH_BACKEND]
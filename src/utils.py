@@ -1,18 +1,103 @@
 from fnmatch import fnmatchcase
-import os,logging, sqlite3
+import os,logging, sqlite3, hashlib
 from tabulate import tabulate
 from scripts import ogr2ogr
+from src.constants import (METADATA_TABLE, TILES_LAYOUT_KEY, ROWID_LAYOUT, CLUSTERED_LAYOUT, TERRAIN_TILES_TABLE, LAYER_JSON_TABLE,
+                           TILE_BLOBS_TABLE, DEDUPE_KEY)
+
+# Clustered layout: the fid packs (zoom_level, tile_column, tile_row), so rows are stored in tile order
+TILE_KEY_BITS = 26
 
 def patterns_match(path, patterns):
     return any(fnmatchcase(path, p) for p in patterns)
 
+def get_tile_key(zoom_level, tile_column, tile_row):
+    if tile_column >> TILE_KEY_BITS or tile_row >> TILE_KEY_BITS:
+        raise ValueError(f"Tile {zoom_level}/{tile_column}/{tile_row} is out of range for the clustered layout")
+
+    return (zoom_level << (2 * TILE_KEY_BITS)) | (tile_column << TILE_KEY_BITS) | tile_row
+
+def get_tile_key_range(zoom_level, tile_column):
+    """First and last key of a (zoom_level, tile_column) group in the clustered layout"""
+    first_key = get_tile_key(zoom_level, tile_column, 0)
+    return first_key, first_key + (1 << TILE_KEY_BITS) - 1
+
+def read_gpkg_metadata(gpkg_path):
+    """Returns the key/value pairs of the metadata table, empty for GeoPackages created before it existed"""
+    db_connection = sqlite3.connect(f'file:{gpkg_path}?mode=ro', uri=True)
+
+    try:
+        has_metadata = db_connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (METADATA_TABLE,)
+        ).fetchone()
+        if not has_metadata:
+            return {}
+
+        return dict(db_connection.execute(f"SELECT key, value FROM {METADATA_TABLE} ORDER BY fid"))
+    finally:
+        db_connection.close()
+
+def get_tiles_layout(metadata):
+    return metadata.get(TILES_LAYOUT_KEY, ROWID_LAYOUT)
+
+def is_deduplicated(metadata):
+    return metadata.get(DEDUPE_KEY) == "true"
+
+def get_tile_hash(tile_data):
+    return hashlib.blake2b(tile_data, digest_size=16).hexdigest()
+
+def get_tiles_data_select(deduplicated, where=None):
+    """SELECT of the tiles table aliased as t (conditions in where must use it), tile_data resolved from the blobs when deduplicated"""
+    if deduplicated:
+        # Rows appended from non-deduplicated GeoPackages (--dump) keep their own tile_data
+        select = (f"SELECT t.zoom_level AS zoom_level, t.tile_column AS tile_column, t.tile_row AS tile_row, "
+                  f"COALESCE(b.tile_data, t.tile_data) AS tile_data "
+                  f"FROM {TERRAIN_TILES_TABLE} t LEFT JOIN {TILE_BLOBS_TABLE} b ON b.fid = t.blob_id")
+    else:
+        select = f"SELECT t.zoom_level AS zoom_level, t.tile_column AS tile_column, t.tile_row AS tile_row, t.tile_data AS tile_data FROM {TERRAIN_TILES_TABLE} t"
+
+    return f"{select} WHERE {where}" if where else select
+
 def gpkg_dump(destination_gpkg, source_gpkg):
     logger = logging.getLogger(__name__)
 
     destination_gpkg = os.path.join(os.getcwd(), destination_gpkg)
     source_gpkg = os.path.join(os.getcwd(), source_gpkg)
 
-    result = ogr2ogr.main(['ogr2ogr', '-f', 'GPKG', '-append', destination_gpkg, source_gpkg])
+    ogr2ogr_args = ['ogr2ogr', '-f', 'GPKG', '-append']
+    source_metadata = read_gpkg_metadata(source_gpkg)
+    source_layout = get_tiles_layout(source_metadata)
+
+    if is_deduplicated(source_metadata):
+        # Blob references are only valid inside the source, dump the resolved tiles as a plain GeoPackage
+        if os.path.exists(destination_gpkg) and get_tiles_layout(read_gpkg_metadata(destination_gpkg)) == CLUSTERED_LAYOUT:
+            logger.error(f"Cannot dump the deduplicated {source_gpkg} into {destination_gpkg}, the destination uses the {CLUSTERED_LAYOUT} layout")
+            return 1
+
+        logger.info(f"Merging deduplicated {source_gpkg} to {destination_gpkg}...")
+        result = ogr2ogr.main([*ogr2ogr_args, destination_gpkg, source_gpkg, '-sql', get_tiles_data_select(True), '-nln', TERRAIN_TILES_TABLE])
+        if result:
+            result = ogr2ogr.main([*ogr2ogr_args, destination_gpkg, source_gpkg, LAYER_JSON_TABLE])
+
+        if not result:
+            logger.error("Error executing ogr2ogr command:")
+        return not result
+
+    if os.path.exists(destination_gpkg):
+        if get_tiles_layout(read_gpkg_metadata(destination_gpkg)) == CLUSTERED_LAYOUT:
+            if source_layout != CLUSTERED_LAYOUT:
+                logger.error(f"Cannot dump {source_gpkg} into {destination_gpkg}, the destination uses the {CLUSTERED_LAYOUT} layout and the source doesn't")
+                return 1
+            return merge_clustered_gpkg(destination_gpkg, source_gpkg)
+
+        # Keep the destination metadata, only append the data layers
+        ogr2ogr_args += [destination_gpkg, source_gpkg, TERRAIN_TILES_TABLE, LAYER_JSON_TABLE]
+    else:
+        if source_layout == CLUSTERED_LAYOUT:
+            ogr2ogr_args.append('-preserve_fid')
+        ogr2ogr_args += [destination_gpkg, source_gpkg]
+
+    result = ogr2ogr.main(ogr2ogr_args)
     
     logger.info(f"Merging {source_gpkg} to {destination_gpkg}...")
 
@@ -24,6 +109,25 @@ def gpkg_dump(destination_gpkg, source_gpkg):
     # result True -> exit(0) | False -> exit(1)
     return not result
 
+def merge_clustered_gpkg(destination_gpkg, source_gpkg):
+    """Merges a clustered source into a clustered destination, ogr2ogr -append -preserve_fid would abort on existing keys"""
+    # TileWriter imports this module
+    from src.TileWriter import SQLiteTileWriter
+    logger = logging.getLogger(__name__)
+
+    logger.info(f"Merging {source_gpkg} to {destination_gpkg}...")
+    writer = SQLiteTileWriter(destination_gpkg, CLUSTERED_LAYOUT)
+    try:
+        writer.merge_gpkg(source_gpkg)
+    except Exception as e:
+        logger.error(f"Error merging {source_gpkg} to {destination_gpkg}: {e}")
+        return 1
+    finally:
+        writer.close()
+
+    logger.debug(f"Successfully merged {source_gpkg} to {destination_gpkg}!")
+    return 0
+
 def execute_sql(sql_statement, db_path):
     logger = logging.getLogger(__name__)
     db_connection = None
@@ -0,0 +1,57 @@
+import os
+from queue import Queue
+from src.EventCoalescer import EventCoalescer
+
+def write_file(path, data):
+    with open(path, "wb") as tile_file:
+        tile_file.write(data)
+
+def drain(event_queue):
+    paths = []
+    while not event_queue.empty():
+        paths.append(event_queue.get()[0])
+    return paths
+
+def test_metadata_event_after_close_is_not_emitted_again(tmp_path):
+    tile_path = str(tmp_path / "1.terrain")
+    event_queue = Queue()
+    coalescer = EventCoalescer(event_queue, settle_seconds=0)
+
+    write_file(tile_path, b"tile")
+    coalescer.file_changed(tile_path)
+    coalescer.file_finished(tile_path)
+
+    # chmod after the close: a modified event and no close
+    os.chmod(tile_path, 0o600)
+    coalescer.file_changed(tile_path)
+    coalescer.emit_settled()
+
+    assert drain(event_queue) == [tile_path]
+    assert coalescer.dropped_events == 1
+
+def test_write_after_close_is_emitted_again(tmp_path):
+    tile_path = str(tmp_path / "1.terrain")
+    event_queue = Queue()
+    coalescer = EventCoalescer(event_queue, settle_seconds=0)
+
+    write_file(tile_path, b"tile")
+    coalescer.file_changed(tile_path)
+    coalescer.file_finished(tile_path)
+
+    write_file(tile_path, b"new tile")
+    coalescer.file_changed(tile_path)
+    coalescer.file_finished(tile_path)
+
+    assert drain(event_queue) == [tile_path, tile_path]
+
+def test_rename_into_place_is_emitted_again(tmp_path):
+    tile_path = str(tmp_path / "1.terrain")
+    event_queue = Queue()
+    coalescer = EventCoalescer(event_queue, settle_seconds=0)
+
+    write_file(tile_path, b"tile")
+    coalescer.file_changed(tile_path)
+    coalescer.file_finished(tile_path)
+    coalescer.file_finished(tile_path, is_new_version=True)
+
+    assert drain(event_queue) == [tile_path, tile_path]
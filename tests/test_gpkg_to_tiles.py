@@ -0,0 +1,73 @@
+import os
+import pytest
+
+pytest.importorskip("osgeo")
+
+from src.GpkgToTiles import GpkgToTiles
+from src.ExtractManifest import ExtractManifest
+from src.utils import get_tile_hash
+
+class FakeFeature:
+    def __init__(self, zoom_level, tile_column, tile_row, tile_data):
+        self.fields = {"zoom_level": zoom_level, "tile_column": tile_column, "tile_row": tile_row}
+        self.tile_data = tile_data
+
+    def GetField(self, name):
+        return self.fields[name]
+
+    def GetFieldAsBinary(self, name):
+        return self.tile_data
+
+class FakeDataSource:
+    """Returns the rows in the given order, like the ordered query of the extraction"""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def ExecuteSQL(self, query):
+        return [FakeFeature(*row) for row in self.rows]
+
+    def ReleaseResultSet(self, result_set):
+        pass
+
+def extract(output_dir, rows, has_tiles_index=True):
+    gpkg_to_tiles = GpkgToTiles("unused.gpkg", str(output_dir), 2, incremental=True)
+    gpkg_to_tiles.has_tiles_index = has_tiles_index
+    gpkg_to_tiles.manifest = ExtractManifest(str(output_dir))
+    gpkg_to_tiles.manifest.open()
+    try:
+        gpkg_to_tiles.extract_terrain_tiles(FakeDataSource(rows))
+    finally:
+        gpkg_to_tiles.manifest.close()
+    return gpkg_to_tiles
+
+def record_previous_run(output_dir, tile_data):
+    """A previous run wrote and recorded the newest row of tile 5/3/1"""
+    os.makedirs(os.path.join(output_dir, "5", "3"))
+    with open(os.path.join(output_dir, "5", "3", "1.terrain"), "wb") as tile_file:
+        tile_file.write(tile_data)
+    manifest = ExtractManifest(str(output_dir))
+    manifest.open()
+    manifest.add(5, 3, 1, len(tile_data), get_tile_hash(tile_data))
+    manifest.close()
+
+def read_tile(output_dir):
+    with open(os.path.join(output_dir, "5", "3", "1.terrain"), "rb") as tile_file:
+        return tile_file.read()
+
+@pytest.mark.parametrize("has_tiles_index", [True, False])
+def test_duplicated_rows_of_equal_size_keep_the_newest(tmp_path, has_tiles_index):
+    oldest, newest = b"old-tile", b"new-tile"
+    record_previous_run(tmp_path, newest)
+
+    extract(tmp_path, [(5, 3, 1, oldest), (5, 3, 1, newest)], has_tiles_index)
+
+    assert read_tile(tmp_path) == newest
+
+def test_duplicated_rows_are_not_rewritten(tmp_path):
+    oldest, newest = b"old-tile", b"new-tile"
+    record_previous_run(tmp_path, newest)
+
+    gpkg_to_tiles = extract(tmp_path, [(5, 3, 1, oldest), (5, 3, 1, newest)])
+
+    assert gpkg_to_tiles.metrics.tiles == 0
+    assert gpkg_to_tiles.skipped_count == 1
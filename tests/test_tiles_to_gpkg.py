@@ -0,0 +1,66 @@
+import os
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("watchdog")
+
+from src.TilesToGpkg import TilesToGpkg
+from src.Metrics import Metrics
+from src.HistoryDB import HistoryDatabase
+
+def make_tiles(source_dir, zoom_level, columns, rows):
+    for tile_column in range(columns):
+        tile_dir = os.path.join(source_dir, str(zoom_level), str(tile_column))
+        os.makedirs(tile_dir)
+        for tile_row in range(rows):
+            with open(os.path.join(tile_dir, f"{tile_row}.terrain"), "wb") as tile_file:
+                tile_file.write(bytes([zoom_level, tile_column, tile_row]))
+
+class EtaRecordingTilesToGpkg(TilesToGpkg):
+    def __init__(self, *args, **kwargs):
+        self.etas = []
+        super().__init__(*args, **kwargs)
+
+    def write_tile(self, tile):
+        # Deterministic: the count finishes long before the last tile in real trees
+        if self.count_thread:
+            self.count_thread.join()
+        super().write_tile(tile)
+        self.etas.append(self.metrics.snapshot()["eta_seconds"])
+
+def test_eta_is_known_during_the_ingest(tmp_path):
+    source_dir = tmp_path / "tiles"
+    make_tiles(str(source_dir), 3, 4, 5)
+
+    tiles_to_gpkg = EtaRecordingTilesToGpkg(str(source_dir), str(tmp_path / "out.gpkg"), False, ["*.terrain"],
+                                            read_workers=0, metrics=Metrics())
+
+    assert len(tiles_to_gpkg.etas) == 20
+    assert tiles_to_gpkg.etas[0] is not None
+    assert tiles_to_gpkg.etas[-1] == 0
+    assert tiles_to_gpkg.metrics.discovered == 20
+
+def test_catch_up_after_a_restart_skips_the_ingested_tiles(tmp_path):
+    source_dir = tmp_path / "tiles"
+    make_tiles(str(source_dir), 3, 1, 3)
+    tile_dir = os.path.join(str(source_dir), "3", "0")
+    ctimes = {tile_row: os.stat(os.path.join(tile_dir, f"{tile_row}.terrain")).st_ctime_ns for tile_row in range(3)}
+    history_path = str(tmp_path / "out.gpkg.history.sqlite")
+
+    # The previous session ingested tiles 0 and 1, tile 2 was still queued when it stopped
+    history_db = HistoryDatabase(history_path)
+    for tile_row in (0, 1):
+        history_db.update_history("3/0", ctimes[tile_row], tile_row)
+    history_db.close_connection()
+
+    # Written while the service was down
+    with open(os.path.join(tile_dir, "3.terrain"), "wb") as tile_file:
+        tile_file.write(b"new")
+
+    tiles_to_gpkg = TilesToGpkg.__new__(TilesToGpkg)
+    tiles_to_gpkg.history_db = HistoryDatabase(history_path)
+    files = [(f"{tile_row}.terrain", tile_row) for tile_row in range(4)]
+    changed_rows = [tile[3] for tile in tiles_to_gpkg.find_changed_tiles(tile_dir, 3, 0, files)]
+    tiles_to_gpkg.history_db.close_connection()
+
+    assert changed_rows == [2, 3]